@@ -4,10 +4,17 @@ import csv
 import io
 import json
 import logging
+import math
+import random
+import time
+import uuid
 import ftplib
+from concurrent.futures import ThreadPoolExecutor
 import functions_framework
+from google.api_core import exceptions as api_exceptions
 from google.cloud import bigquery
 from google.cloud import secretmanager
+from google.cloud import storage
 import datetime
 
 # ログ設定
@@ -20,7 +27,60 @@ DATASET_ID = os.environ.get("DATASET_ID") # 例: kolbi_analysis または kolbi_
 SECRET_USER = os.environ.get("SECRET_USER") # ユーザー名のシークレットリソースID
 SECRET_PASS = os.environ.get("SECRET_PASS") # パスワードのシークレットリソースID
 STATE_TABLE_NAME = "race_uma_details_export_state"
+SOURCE_TABLE_NAME = "race_uma_details" # エクスポート元のマートテーブル
+WATERMARK_LABEL = "last_source_modified_ms" # 状態管理テーブルに記録する前回エクスポート時のソース最終更新時刻
+NEXT_PART_LABEL = "next_part_start" # 途中で終了した通常実行の続きのパート番号 (状態管理テーブルのラベル)
 FTP_HOST = "smartkb.mixh.jp"
+EXPORT_SINKS = os.environ.get("EXPORT_SINKS", "ftp") # 送信先(カンマ区切り) 例: ftp,gcs:bucket/prefix,local:/tmp/export
+EXPORT_OPTIONAL_SINKS = os.environ.get("EXPORT_OPTIONAL_SINKS", "") # 失敗しても再送しない送信先(形式は EXPORT_SINKS と同じ)
+EXPORT_DEADLINE_SECONDS = os.environ.get("EXPORT_DEADLINE_SECONDS") # 新しいパートを取るのをやめる経過秒数 (未設定なら無制限)
+MERGE_RETRY_SECONDS = 240 # 並列シャードのMERGEが競合した場合に再試行を続ける最大秒数
+CHUNK_SIZE = 1000
+
+# CSV出力用フィールド定義
+FIELDNAMES = [
+    "race_code_uma_kol", "race_code_uma_jvd", "race_code_kol", "race_code_jvd", "keibajo_code_jvd", "keibajo_code_kol",
+    "hasso_date", "kaiji", "nichiji", "race_bango", "race_bango_num", "waku_kubun", "wakuban", "umaban", "umaban_num", "umaban_even",
+    "bamei", "seibetsu_code", "seibetsu_code_label", "barei", "barei_num", "futan_juryo", "futan_juryo_float",
+    "blinker_shiyo_kubun", "blinker_shiyo_kubun_label", "rating", "rating_float",
+    "banushimei", "banushimei_ryakusho", "ketto_toroku_bango_kol", "ketto1_f_hanshoku_toroku_bango", "ketto1_f_bamei",
+    "ketto2_m_hanshoku_toroku_bango", "ketto2_m_bamei", "ketto5_mf_hanshoku_toroku_bango", "ketto5_mf_bamei", "kyuyo_riyu",
+    "kishumei", "kishumei_ryakusho", "kishu_code", "kishu_tozai_shozoku_code", "kishu_tozai_shozoku_code_label",
+    "kishu_minarai_code", "kishu_minarai_code_label", "kishu_norikawari_kubun", "kishu_norikawari_kubun_label",
+    "kishu_shozokubasho_code", "kishu_shozokubasho_code_label", "kishu_shozoku_chokyoshi_code",
+    "chokyoshi_code", "chokyoshimei", "chokyoshimei_ryakusho", "chokyoshi_shozokubasho_code", "chokyoshi_shozokubasho_code_label",
+    "chokyoshi_tracen_kubun", "chokyoshi_tracen_kubun_label",
+    "chokyo_flag", "chokyo_flag_label", "chokyo_kijosha", "chokyo_kijosha_equal_kishumei_flag", "chokyo_nengappi", "chokyo_nengappi_label", "chokyo_nengappi_date",
+    "chokyo_basho", "chokyo_course", "chokyo_course_kubun", "chokyo_basho_course_label", "chokyo_babajotai", "chokyo_hanro_pool_kaisu_int",
+    "chokyo_8f", "chokyo_8f_float", "chokyo_7f", "chokyo_7f_float", "chokyo_6f", "chokyo_6f_float", "chokyo_5f", "chokyo_5f_float",
+    "chokyo_4f", "chokyo_4f_float", "chokyo_3f", "chokyo_3f_float", "chokyo_2f_float", "chokyo_1f", "chokyo_1f_float",
+    "chokyo_lap_8f", "chokyo_lap_7f", "chokyo_lap_6f", "chokyo_lap_5f", "chokyo_lap_4f", "chokyo_lap_3f", "chokyo_lap_2f", "chokyo_lap_group",
+    "shirushi_hanro_4f_flag", "shirushi_hanro_1f_flag", "shirushi_wood_6f_flag", "shirushi_wood_1f_flag",
+    "shirushi_point", "shirushi_kubun_yosou_tansho_ninkijun", "shirushi_kubun_rank", "shirushi_shirushi_label", "shirushi_shirushi_num",
+    "chokyo_ichidori", "chokyo_ichidori_label", "chokyo_ashiiro", "chokyo_ashiiro_label", "chokyo_yajirushi", "chokyo_yajirushi_label",
+    "chokyo_reigai", "chokyo_awase", "chokyo_awase_kubun", "chokyo_awase_flag", "chokyo_awase_flag_label", "chokyo_tanpyo",
+    "chokyo_honsu_course", "chokyo_honsu_course_num", "chokyo_honsu_hanro", "chokyo_honsu_hanro_num", "chokyo_honsu_pool", "chokyo_honsu_pool_num",
+    "speed_sisu_last_1", "speed_sisu_last_1_float", "speed_sisu_last_2", "speed_sisu_last_2_float", "speed_sisu_last_3", "speed_sisu_last_3_float",
+    "speed_sisu_last_4", "speed_sisu_last_4_float", "speed_sisu_last_5", "speed_sisu_last_5_float",
+    "rotation1", "rotation1_label", "rotation2", "rotation2_label", "rotation3", "rotation3_label", "rotation4", "rotation4_label",
+    "rotation5", "rotation5_label", "rotation6", "rotation6_label", "rotation7", "rotation7_label", "rotation8", "rotation8_label", "zensou_kankaku",
+    "bataiju", "bataiju_kubun", "bataiju_zensou", "bataiju_kubun_zensou", "kyori_kubun_zensou", "kyori_extension_flag", "kyori_shortening_flag",
+    "ensei_kansai_to_kantou_flag", "ensei_kantou_to_kansai_flag", "ensei_flag", "track_code1_label_dirtsiba_zensou", "siba_to_dirt_flag", "dirt_to_siba_flag",
+    "record_shisu", "record_shisu_num", "zogen_sa", "zogen_sa_num", "tansho_ninkijun", "tansho_ninkijun_num", "tansho_odds", "tansho_odds_float",
+    "kakutei_chakujun", "kakutei_chakujun_num", "tansho_haraimodoshi", "tansho_haraimodoshi_num", "fukusho_haraimodoshi", "fukusho_haraimodoshi_num",
+    "ijo_kubun_code1", "ijo_kubun_code1_label", "ijo_kubun_code2", "ijo_kubun_code2_label", "nyusen_juni", "nyusen_juni_num", "record_flag", "record_flag_label",
+    "soha_time", "soha_time_float", "soha_time_label", "chakusa_code1", "chakusa_code1_num", "chakusa_code2", "chakusa_code2_label", "chakusa_label",
+    "time_sa", "time_sa_float", "zenhan_3f", "zenhan_3f_float", "kohan_3f", "kohan_3f_float",
+    "corner1_juni", "corner1_juni_label", "corner2_juni", "corner2_juni_label", "corner3_juni", "corner3_juni_label", "corner4_juni", "corner4_juni_label", "corner4_ichidori", "corner4_ichidori_label",
+    "race_name", "kyori_kubun", "keibajo_name", "chuo_chiho_kubun", "chuo_chiho_kubun_label", "kyosomei_15moji", "kyosomei_7moji",
+    "grade_code", "grade_code_label", "jpn_flag", "jpn_flag_label", "bettei_barei_handicap_summary_code", "bettei_barei_handicap_summary_code_label", "bettei_barei_handicap_detail",
+    "kyoso_joken_age_limit", "kyoso_joken_age_limit_label", "kyoso_joken_kubun", "kyoso_joken_kubun_label", "heichi_shogai_kubun", "heichi_shogai_kubun_label",
+    "track_code1_dirtsiba", "track_code1_dirtsiba_label", "track_code2_LRS", "track_code2_LRS_label", "track_code3_inout", "track_code3_inout_label",
+    "course_kubun", "course_kubun_label", "kyori", "toroku_tosu_num", "torikeshi_tosu_num", "tenko_code", "tenko_code_label",
+    "babajotai_code", "babajotai_code_label", "pace_yosou", "pace_yosou_label", "pace_kekka", "pace_kekka_label", "race_tanpyo",
+    "juryo_handicap_flag", "keibajo_komawari_curve4_flag", "keibajo_omawari_curve4_flag", "keibajo_straight_short_flag", "keibajo_straight_long_flag",
+    "created", "modified"
+]
 
 def get_secret(secret_id):
     """Secret Managerからシークレット値を取得する"""
@@ -43,42 +103,449 @@ def ensure_state_table(bq_client, dataset_id, table_name):
     except Exception:
         logger.info(f"テーブル {table_ref} を作成しています...")
         table = bigquery.Table(table_ref, schema=schema)
-        bq_client.create_table(table)
+        # 並列シャードが同時に作成しても失敗しないよう exists_ok を指定
+        bq_client.create_table(table, exists_ok=True)
         logger.info(f"テーブル {table_ref} を作成しました。")
 
+class FtpSink:
+    """FTPサーバーへの送信先"""
 
-@functions_framework.http
-def export_race_uma_details(request):
-    """更新されたレース詳細情報(race_uma_details)をFTPにエクスポートするHTTP Cloud Function"""
-    try:
-        # 1. クライアントの初期化
-        bq_client = bigquery.Client(project=PROJECT_ID)
+    def __init__(self, host, user, password, directory=None):
+        self.name = f"ftp:{host}"
+        self.host = host
+        self.user = user
+        self.password = password
+        self.directory = directory
+        self.ftp = None
 
-        # 2. FTP認証情報の取得
-        logger.info("FTP認証情報を取得中...")
-        ftp_user = get_secret(SECRET_USER)
-        ftp_pass = get_secret(SECRET_PASS)
+    def open(self):
+        self.ftp = ftplib.FTP(self.host)
+        self.ftp.login(user=self.user, passwd=self.password)
 
-        # 3. 状態管理テーブルの確認
-        ensure_state_table(bq_client, DATASET_ID, STATE_TABLE_NAME)
+        # ディレクトリ移動
+        if self.directory:
+            try:
+                self.ftp.cwd(self.directory)
+            except ftplib.error_perm:
+                logger.info(f"ディレクトリ {self.directory} が存在しないため作成します。")
+                self.ftp.mkd(self.directory)
+                self.ftp.cwd(self.directory)
 
-        # 4. 更新のクエリ
-        # BigQuery側でハッシュ計算と差分抽出を行い、Python側のメモリ負荷を軽減する
-        # created, modified は更新のたびに変わるため、ハッシュ計算から除外する
-        query = f"""
+    def put(self, filename, data):
+        self.ftp.storbinary(f"STOR {filename}", io.BytesIO(data))
+
+    def close(self):
+        if self.ftp is not None:
+            try:
+                self.ftp.quit()
+            except Exception:
+                self.ftp.close()
+            self.ftp = None
+
+class GcsSink:
+    """GCSバケットへの送信先"""
+
+    def __init__(self, bucket_name, prefix=""):
+        self.name = f"gcs:{bucket_name}/{prefix}".rstrip("/")
+        self.bucket_name = bucket_name
+        self.prefix = prefix.strip("/")
+        self.bucket = None
+
+    def open(self):
+        self.bucket = storage.Client(project=PROJECT_ID).bucket(self.bucket_name)
+
+    def put(self, filename, data):
+        blob_name = f"{self.prefix}/{filename}" if self.prefix else filename
+        self.bucket.blob(blob_name).upload_from_string(data, content_type="text/csv")
+
+    def close(self):
+        self.bucket = None
+
+class LocalDirSink:
+    """ローカルディレクトリへの送信先(動作確認用)"""
+
+    def __init__(self, path):
+        self.name = f"local:{path}"
+        self.path = path
+
+    def open(self):
+        os.makedirs(self.path, exist_ok=True)
+
+    def put(self, filename, data):
+        with open(os.path.join(self.path, filename), "wb") as f:
+            f.write(data)
+
+    def close(self):
+        pass
+
+def build_sinks(spec, required=True):
+    """EXPORT_SINKS / EXPORT_OPTIONAL_SINKS の設定(カンマ区切り)から送信先を生成する
+
+    required=False の送信先は失敗しても状態管理テーブルの更新を妨げない(未受信のパートは再送されない)。
+
+    ftp                   : FTP_HOST の FTP_DIRECTORY (認証情報はSecret Managerから取得)
+    gcs:<bucket>[/<prefix>]: GCSバケット
+    local:<path>          : ローカルディレクトリ
+    """
+    sinks = []
+    for entry in (s.strip() for s in spec.split(",")):
+        if not entry:
+            continue
+        kind, _, target = entry.partition(":")
+        if kind == "ftp":
+            logger.info("FTP認証情報を取得中...")
+            ftp_user = get_secret(SECRET_USER)
+            ftp_pass = get_secret(SECRET_PASS)
+            sinks.append(FtpSink(FTP_HOST, ftp_user, ftp_pass, os.environ.get("FTP_DIRECTORY")))
+        elif kind == "gcs":
+            bucket_name, _, prefix = target.partition("/")
+            sinks.append(GcsSink(bucket_name, prefix))
+        elif kind == "local":
+            sinks.append(LocalDirSink(target))
+        else:
+            raise ValueError(f"未対応の送信先です: {entry}")
+    if required and not sinks:
+        raise ValueError("EXPORT_SINKS に送信先が設定されていません。")
+    for sink in sinks:
+        sink.required = required
+    return sinks
+
+class SinkFanout:
+    """シリアライズ済みの1パートを、同じバイト列のまま複数の送信先へ並列に送信する
+
+    送信先ごとに成功・失敗を記録し、失敗した送信先には以降のパートを送らない。
+    必須の送信先が1つでも失敗した時点で送信を打ち切る。
+    送信先は最初のパート送信時に接続する(更新がない場合は接続しない)。
+    """
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+        self.uploaded = {sink.name: 0 for sink in sinks}
+        self.errors = {}
+        self.opened = False
+        self.executor = ThreadPoolExecutor(max_workers=len(sinks))
+
+    def active_sinks(self):
+        return [sink for sink in self.sinks if sink.name not in self.errors]
+
+    def _run(self, method, *args):
+        """送信可能な送信先でメソッドを並列実行し、成功した送信先を返す"""
+        futures = [(sink, self.executor.submit(getattr(sink, method), *args)) for sink in self.active_sinks()]
+        succeeded = []
+        for sink, future in futures:
+            try:
+                future.result()
+                succeeded.append(sink)
+            except Exception as e:
+                logger.error(f"送信先 {sink.name} でエラーが発生しました ({method}): {e}")
+                self.errors[sink.name] = str(e)
+        return succeeded
+
+    def put(self, filename, data):
+        """全送信先へ送信する。必須の送信先が全て受信した場合にTrueを返す"""
+        if not self.opened:
+            self._run("open")
+            self.opened = True
+        for sink in self._run("put", filename, data):
+            self.uploaded[sink.name] += 1
+        return self.required_succeeded()
+
+    def close(self):
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except Exception as e:
+                logger.warning(f"送信先 {sink.name} のクローズに失敗しました: {e}")
+        self.executor.shutdown()
+
+    def required_succeeded(self):
+        return not any(sink.required and sink.name in self.errors for sink in self.sinks)
+
+    def results(self):
+        """送信先ごとのアップロード済みパート数とエラー"""
+        return {
+            sink.name: {
+                "required": sink.required,
+                "uploaded_parts": self.uploaded[sink.name],
+                "error": self.errors.get(sink.name),
+            }
+            for sink in self.sinks
+        }
+
+def state_table_exists(bq_client, dataset_id, table_name):
+    """状態管理テーブルが存在するかを確認する(作成はしない)"""
+    try:
+        bq_client.get_table(f"{PROJECT_ID}.{dataset_id}.{table_name}")
+        return True
+    except Exception:
+        return False
+
+def get_request_params(request):
+    """クエリパラメータとJSONボディをまとめて辞書として取得する(ボディ優先)"""
+    params = dict(request.args) if request.args else {}
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        params.update(body)
+    return params
+
+def parse_bool(value):
+    """リクエストパラメータの真偽値を解釈する"""
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ("1", "true", "yes", "on")
+
+def parse_epoch_ms(value):
+    """last_modified_time(エポックミリ秒またはISO 8601文字列)をエポックミリ秒に変換する"""
+    if value is None or value == "":
+        return None
+    if isinstance(value, bool):
+        raise ValueError(f"真偽値は時刻として扱えません: {value}")
+    if isinstance(value, (int, float)):
+        return int(value)
+    value = str(value).strip()
+    if value.isdigit():
+        return int(value)
+    dt = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return int(dt.timestamp() * 1000)
+
+def get_source_modified_ms(bq_client):
+    """ソースマートの最終更新時刻(エポックミリ秒)をテーブルのメタデータから取得する(クエリは発行しない)"""
+    table = bq_client.get_table(f"{PROJECT_ID}.{DATASET_ID}.{SOURCE_TABLE_NAME}")
+    return int(table.modified.timestamp() * 1000)
+
+def get_reported_modified_ms(params):
+    """ペイロードの tables.<テーブル名>.last_modified_time (呼び出し元が申告した最終更新時刻)を返す(指定なしの場合はNone)"""
+    table_info = (params.get("tables") or {}).get(SOURCE_TABLE_NAME) or {}
+    return parse_epoch_ms(table_info.get("last_modified_time"))
+
+def get_export_watermark(bq_client):
+    """前回エクスポート成功時のソースマート最終更新時刻を状態管理テーブルのラベルから取得する"""
+    try:
+        table = bq_client.get_table(f"{PROJECT_ID}.{DATASET_ID}.{STATE_TABLE_NAME}")
+    except Exception:
+        return None
+    value = (table.labels or {}).get(WATERMARK_LABEL)
+    return int(value) if value else None
+
+def set_export_watermark(bq_client, modified_ms):
+    """エクスポート成功時のソースマート最終更新時刻を状態管理テーブルのラベルに記録する
+
+    全件を送り終えたため、続きのパート番号のラベルは削除する。
+    """
+    table = bq_client.get_table(f"{PROJECT_ID}.{DATASET_ID}.{STATE_TABLE_NAME}")
+    table.labels = {**(table.labels or {}), WATERMARK_LABEL: str(modified_ms), NEXT_PART_LABEL: None}
+    bq_client.update_table(table, ["labels"])
+
+def get_next_part_start(bq_client):
+    """途中で終了した通常実行の続きのパート番号を状態管理テーブルのラベルから取得する(なければ1)"""
+    table = bq_client.get_table(f"{PROJECT_ID}.{DATASET_ID}.{STATE_TABLE_NAME}")
+    value = (table.labels or {}).get(NEXT_PART_LABEL)
+    return int(value) if value else 1
+
+def set_next_part_start(bq_client, part_num):
+    """通常実行が途中で終了した場合に、続きのパート番号を状態管理テーブルのラベルに記録する"""
+    table = bq_client.get_table(f"{PROJECT_ID}.{DATASET_ID}.{STATE_TABLE_NAME}")
+    table.labels = {**(table.labels or {}), NEXT_PART_LABEL: str(part_num)}
+    bq_client.update_table(table, ["labels"])
+
+def validate_dataform_params(params):
+    """dataform_actions / tables の形式を検証する(不正な場合はValueError)"""
+    actions = params.get("dataform_actions")
+    if actions is not None:
+        if not isinstance(actions, list) or not all(
+            isinstance(a, dict) and isinstance(a.get("target") or {}, dict) for a in actions
+        ):
+            raise ValueError("dataform_actions は workflowInvocationActions と同じ形式のオブジェクトの配列で指定してください。")
+    tables = params.get("tables")
+    if tables is not None:
+        if not isinstance(tables, dict) or not all(isinstance(t, dict) for t in tables.values()):
+            raise ValueError('tables は {"テーブル名": {"last_modified_time": ...}} の形式で指定してください。')
+        now_ms = int(datetime.datetime.now(datetime.timezone.utc).timestamp() * 1000)
+        for table_info in tables.values():
+            try:
+                modified_ms = parse_epoch_ms(table_info.get("last_modified_time"))
+            except (TypeError, ValueError):
+                raise ValueError(f"last_modified_time はエポックミリ秒またはISO 8601で指定してください: {table_info}")
+            if modified_ms is not None and modified_ms > now_ms:
+                raise ValueError(f"last_modified_time に未来の時刻は指定できません: {table_info}")
+
+def get_skip_reason(bq_client, params):
+    """ソースマートが前回のエクスポート以降に再構築されていなければ、スキップ理由を返す(再構築済みならNone)
+
+    判定はソースマートの最終更新時刻とウォーターマークの比較を優先する。
+    アップロード失敗などでウォーターマークが遅れている場合は、Dataformの実行対象でなくても再試行する。
+    Workflowsは読み込まれたテーブルに依存するマートだけをDataformで再構築するため、
+    実行対象外のマートは最終更新時刻が進まず、ここでスキップされる。
+    ウォーターマークがない場合のみ、Dataformのアクションで判定する。
+
+    dataform_actions: Dataform workflowInvocations.query の workflowInvocationActions
+    tables: {テーブル名: {"last_modified_time": ...}} (比較にのみ使い、ウォーターマークには記録しない)
+    """
+    watermark = get_export_watermark(bq_client)
+    if watermark is not None:
+        modified_ms = get_reported_modified_ms(params)
+        if modified_ms is None:
+            modified_ms = get_source_modified_ms(bq_client)
+        if modified_ms <= watermark:
+            return f"{SOURCE_TABLE_NAME} は前回のエクスポート以降に再構築されていません。"
+        return None
+
+    actions = params.get("dataform_actions")
+    if actions is not None:
+        action = next(
+            (a for a in actions
+             if (a.get("target") or {}).get("name") == SOURCE_TABLE_NAME
+             and (a.get("target") or {}).get("schema", DATASET_ID) == DATASET_ID),
+            None
+        )
+        if action is None:
+            return f"{SOURCE_TABLE_NAME} はDataformの実行対象に含まれていません。"
+        if action.get("state") != "SUCCEEDED":
+            return f"{SOURCE_TABLE_NAME} のDataformアクションの状態が {action.get('state')} です。"
+    return None
+
+def parse_shard(params):
+    """バックフィル用のシャード指定を解釈する(指定なしの場合はNone)
+
+    shard_index / shard_count: race_code_uma_jvd の安定ハッシュで N 分割したうちの i 番目 (0始まり)
+    year_from / year_to: hasso_date の年の範囲 (両端を含む)
+    """
+    shard = {}
+    for key in ("shard_index", "shard_count", "year_from", "year_to"):
+        value = params.get(key)
+        if value is not None and value != "":
+            # 1.7 や true を 1 として扱わないよう、整数値以外は拒否する
+            if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+                raise ValueError(f"{key} は整数で指定してください: {value}")
+            try:
+                shard[key] = int(value)
+            except (TypeError, ValueError):
+                raise ValueError(f"{key} は整数で指定してください: {value}")
+    if not shard:
+        return None
+    if ("shard_index" in shard) != ("shard_count" in shard):
+        raise ValueError("shard_index と shard_count は両方指定してください。")
+    if "shard_count" in shard and not 0 <= shard["shard_index"] < shard["shard_count"]:
+        raise ValueError(f"shard_index は 0 以上 shard_count 未満で指定してください: {shard}")
+    if "year_from" in shard and "year_to" in shard and shard["year_from"] > shard["year_to"]:
+        raise ValueError(f"year_from は year_to 以下で指定してください: {shard}")
+    return shard
+
+def build_shard_filter(shard):
+    """シャード指定をソーステーブルのWHERE句に変換する"""
+    if not shard:
+        return ""
+    conditions = []
+    if "shard_count" in shard:
+        conditions.append(
+            f"ABS(MOD(FARM_FINGERPRINT(race_code_uma_jvd), {shard['shard_count']})) = {shard['shard_index']}"
+        )
+    # hasso_date の範囲で絞り込み、DATE(hasso_date) のパーティションを刈り込む
+    if "year_from" in shard:
+        conditions.append(f"hasso_date >= DATETIME({shard['year_from']}, 1, 1, 0, 0, 0)")
+    if "year_to" in shard:
+        conditions.append(f"hasso_date < DATETIME({shard['year_to'] + 1}, 1, 1, 0, 0, 0)")
+    return "WHERE " + " AND ".join(conditions)
+
+def parse_deadline_seconds(params):
+    """期限(秒)をリクエストパラメータまたは環境変数から取得する(指定なしの場合はNone)"""
+    value = params.get("deadline_seconds", EXPORT_DEADLINE_SECONDS)
+    if value is None or value == "":
+        return None
+    if isinstance(value, bool):
+        raise ValueError(f"deadline_seconds は数値で指定してください: {value}")
+    try:
+        deadline_seconds = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"deadline_seconds は数値で指定してください: {value}")
+    if not math.isfinite(deadline_seconds) or deadline_seconds <= 0:
+        raise ValueError(f"deadline_seconds は正の数で指定してください: {value}")
+    return deadline_seconds
+
+def parse_part_start(params):
+    """パート番号の開始値をリクエストパラメータから取得する(指定なしの場合はNone)"""
+    value = params.get("part_start")
+    if value is None or value == "":
+        return None
+    if isinstance(value, bool):
+        raise ValueError(f"part_start は整数で指定してください: {value}")
+    try:
+        part_start = int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"part_start は整数で指定してください: {value}")
+    if part_start < 1:
+        raise ValueError(f"part_start は1以上で指定してください: {value}")
+    return part_start
+
+def build_shard_tag(shard):
+    """ハッシュ分割時にシャード間でファイル名が衝突しないよう付与するタグ"""
+    if shard and "shard_count" in shard:
+        return f"_s{shard['shard_index']:02d}of{shard['shard_count']:02d}"
+    return ""
+
+# 再試行するエラー: 同時更新の競合 (BadRequest / Conflict) と一時的な障害
+# MERGE文は固定でロード済みの一時テーブルを参照するため、BadRequest は実質的に競合によるもの
+RETRYABLE_DML_ERRORS = (
+    api_exceptions.BadRequest,
+    api_exceptions.Conflict,
+    api_exceptions.TooManyRequests,
+    api_exceptions.InternalServerError,
+    api_exceptions.ServiceUnavailable,
+)
+
+def run_dml_with_retry(bq_client, query, retry_seconds=MERGE_RETRY_SECONDS, max_wait_seconds=30):
+    """並列シャードのMERGEが同時更新で競合した場合に、待機して再試行する
+
+    待機時間は上限付きの指数バックオフに全区間のジッターをかけ、同時に失敗したシャードの再試行をずらす。
+    retry_seconds を超えたら最後のエラーを送出する。
+    """
+    started_at = time.monotonic()
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return bq_client.query(query).result()
+        except RETRYABLE_DML_ERRORS as e:
+            wait_seconds = random.uniform(0, min(max_wait_seconds, 2 ** attempt))
+            if time.monotonic() - started_at + wait_seconds > retry_seconds:
+                raise
+            logger.warning(f"DMLが失敗したため {wait_seconds:.1f} 秒後に再試行します ({attempt}回目): {e}")
+            time.sleep(wait_seconds)
+
+def build_diff_query(state_available=True, shard=None):
+    """ハッシュ差分抽出クエリを生成する
+
+    状態管理テーブルが存在しない場合(ドライラン時)は空の状態として扱い、全件を差分とみなす。
+    shard が指定された場合は、そのシャードに属する行のみを対象とする。
+    """
+    if state_available:
+        state_source = f"""
+                SELECT
+                    race_code_uma_jvd,
+                    content_hash
+                FROM `{PROJECT_ID}.{DATASET_ID}.{STATE_TABLE_NAME}`"""
+    else:
+        state_source = """
+                SELECT
+                    race_code_uma_jvd,
+                    CAST(NULL AS STRING) AS content_hash
+                FROM UNNEST(ARRAY<STRING>[]) AS race_code_uma_jvd"""
+
+    # BigQuery側でハッシュ計算と差分抽出を行い、Python側のメモリ負荷を軽減する
+    # created, modified は更新のたびに変わるため、ハッシュ計算から除外する
+    return f"""
             WITH SourceWithHash AS (
                 SELECT
                     *,
                     TO_HEX(MD5(TO_JSON_STRING(
                         (SELECT AS STRUCT * EXCEPT(created, modified) FROM UNNEST([t]))
                     ))) as current_hash
-                FROM `{PROJECT_ID}.{DATASET_ID}.race_uma_details` t
+                FROM `{PROJECT_ID}.{DATASET_ID}.{SOURCE_TABLE_NAME}` t
+                {build_shard_filter(shard)}
             ),
-            State AS (
-                SELECT
-                    race_code_uma_jvd,
-                    content_hash
-                FROM `{PROJECT_ID}.{DATASET_ID}.{STATE_TABLE_NAME}`
+            State AS ({state_source}
             )
             SELECT
                 s.*
@@ -89,65 +556,188 @@ def export_race_uma_details(request):
                 OR st.content_hash != s.current_hash
         """
 
+def build_run_tag():
+    """ファイル名に付ける実行ごとのタグ(エクスポート開始時刻, UTC)
+
+    途中で失敗・打ち切りになった実行の残りの行を次回送る際に、送信済みのファイルを上書きしないようにする。
+    """
+    return datetime.datetime.now(datetime.timezone.utc).strftime("_%Y%m%dT%H%M%SZ")
+
+def build_csv(chunk):
+    """チャンクをヘッダー付きCSVのバイト列に変換する"""
+    csv_buffer = io.StringIO()
+    writer = csv.DictWriter(csv_buffer, fieldnames=FIELDNAMES)
+    writer.writeheader()
+    writer.writerows(chunk)
+    return csv_buffer.getvalue().encode('utf-8')
+
+def estimate_export(bq_client, query):
+    """アップロードや状態更新を行わずに、エクスポート規模を見積もる
+
+    - BigQueryのドライランで差分クエリのスキャンバイト数を取得
+    - 差分に対する COUNT / CSV行長の SUM で変更行数とペイロードサイズを算出
+    """
+    dry_run_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+    dry_run_job = bq_client.query(query, job_config=dry_run_config)
+    scan_bytes = dry_run_job.total_bytes_processed
+
+    # CSVの1行 = 各カラムを文字列化してカンマ連結 + 改行(\r\n)。クォートは考慮しない概算値
+    csv_columns = ", ".join(f"IFNULL(CAST(d.`{field}` AS STRING), '')" for field in FIELDNAMES)
+    stats_query = f"""
+        SELECT
+            COUNT(*) AS changed_rows,
+            IFNULL(SUM(BYTE_LENGTH(ARRAY_TO_STRING([{csv_columns}], ',')) + 2), 0) AS row_bytes
+        FROM ({query}) d
+    """
+    stats = list(bq_client.query(stats_query).result())[0]
+
+    changed_rows = stats["changed_rows"]
+    part_count = math.ceil(changed_rows / CHUNK_SIZE)
+    header_bytes = len((",".join(FIELDNAMES) + "\r\n").encode("utf-8"))
+    return {
+        "dry_run": True,
+        "estimated_scan_bytes": scan_bytes,
+        "changed_rows": changed_rows,
+        "part_count": part_count,
+        "chunk_size": CHUNK_SIZE,
+        "estimated_payload_bytes": stats["row_bytes"] + header_bytes * part_count,
+    }
+
+
+def merge_state_updates(bq_client, state_updates):
+    """送信済みの行のハッシュを一時テーブル経由で状態管理テーブルにMERGEする"""
+    if not state_updates:
+        return
+    logger.info(f"状態管理テーブルを更新中... ({len(state_updates)} updates)")
+    # MERGEを使用して状態をUPSERT
+    # 挿入用データの準備
+    rows_to_insert = [
+        {
+            "race_code_uma_jvd": u["race_code_uma_jvd"],
+            "content_hash": u["content_hash"],
+            "exported_at": datetime.datetime.now().isoformat()
+        }
+        for u in state_updates
+    ]
+
+    # 1. 一時テーブルへのロード (JSONロードは大量データに弱い場合があるが、hashとIDだけなら耐えられるか)
+    job_config = bigquery.LoadJobConfig(
+        write_disposition="WRITE_TRUNCATE",
+        schema=[
+            bigquery.SchemaField("race_code_uma_jvd", "STRING"),
+            bigquery.SchemaField("content_hash", "STRING"),
+            bigquery.SchemaField("exported_at", "TIMESTAMP"),
+        ]
+    )
+    # 並列実行されるシャード同士で衝突しないよう、一時テーブル名は実行ごとに一意にする
+    temp_table_id = f"{PROJECT_ID}.{DATASET_ID}.temp_race_uma_details_state_updates_{uuid.uuid4().hex[:12]}"
+
+    try:
+        # チャンク分割してロードすることを検討すべきだが、コード簡略化のため一括
+        # JSON Lines ファイルをGCSに書いてロードするのがベストプラクティスだが、ここでは直接ロード
+        load_job = bq_client.load_table_from_json(rows_to_insert, temp_table_id, job_config=job_config)
+        load_job.result() # 待機
+
+        # 2. マージ実行
+        merge_query = f"""
+            MERGE `{PROJECT_ID}.{DATASET_ID}.{STATE_TABLE_NAME}` T
+            USING `{temp_table_id}` S
+            ON T.race_code_uma_jvd = S.race_code_uma_jvd
+            WHEN MATCHED THEN
+              UPDATE SET content_hash = S.content_hash, exported_at = S.exported_at
+            WHEN NOT MATCHED THEN
+              INSERT (race_code_uma_jvd, content_hash, exported_at)
+              VALUES (race_code_uma_jvd, content_hash, exported_at)
+        """
+        run_dml_with_retry(bq_client, merge_query)
+        logger.info("状態管理テーブルが更新されました。")
+    finally:
+        # ロードやMERGEが失敗しても、実行ごとに一意な一時テーブルを残さない
+        bq_client.delete_table(temp_table_id, not_found_ok=True)
+
+
+@functions_framework.http
+def export_race_uma_details(request):
+    """更新されたレース詳細情報(race_uma_details)を送信先(既定はFTP)にエクスポートするHTTP Cloud Function
+
+    リクエストパラメータ:
+        dry_run: true の場合、アップロードと状態管理テーブルの更新を行わずに見積もりのみ返す
+        dataform_actions / tables: Dataformの実行結果。ソースマートが前回のエクスポート以降に
+            再構築されていない場合、差分クエリを発行せずに終了する
+        shard_index / shard_count, year_from / year_to: バックフィル用のシャード指定。
+            指定したシャードの行のみをエクスポートする (状態管理テーブルのラベルは更新しない)
+        deadline_seconds: 経過時間がこの秒数を超えたら新しいパートを取らず、アップロード済みの分の状態を
+            MERGEして {"status": "partial", "next_part_start": ...} を返す。呼び出し側は完了まで再実行する
+        part_start: パート番号の開始値。シャードの継続実行では next_part_start を渡す。
+            省略した通常実行は、前回途中で終了した実行が状態管理テーブルに記録した番号から始める
+    """
+    try:
+        # 1. クライアントの初期化
+        started_at = time.monotonic()
+        bq_client = bigquery.Client(project=PROJECT_ID)
+        params = get_request_params(request)
+        try:
+            validate_dataform_params(params)
+            shard = parse_shard(params)
+            deadline_seconds = parse_deadline_seconds(params)
+            part_start = parse_part_start(params)
+        except ValueError as e:
+            return f"不正なリクエストパラメータ: {e}", 400
+        if shard:
+            logger.info(f"シャード {shard} を処理します。")
+
+        # ドライラン: 状態管理テーブルを作成・更新せず、見積もりのみ返す
+        if parse_bool(params.get("dry_run", False)):
+            logger.info("ドライランモードで実行中...")
+            state_available = state_table_exists(bq_client, DATASET_ID, STATE_TABLE_NAME)
+            estimate = estimate_export(bq_client, build_diff_query(state_available, shard))
+            logger.info(f"見積もり結果: {estimate}")
+            return estimate, 200
+
+        # 選択的エクスポート: ソースマートが再構築されていなければクエリを発行せずに終了
+        if params.get("dataform_actions") is not None or params.get("tables") is not None:
+            skip_reason = get_skip_reason(bq_client, params)
+            if skip_reason:
+                logger.info(f"エクスポートをスキップします: {skip_reason}")
+                return f"スキップしました。{skip_reason}", 200
+
+        # ウォーターマークには呼び出し元の申告値ではなく、テーブルのメタデータの最終更新時刻を記録する
+        # 最終更新時刻はクエリ前に取得し、実行中に再構築された場合は次回再度エクスポートされるようにする
+        source_modified_ms = get_source_modified_ms(bq_client)
+
+        # 2. 送信先の初期化 (FTP認証情報の取得を含む)
+        fanout = SinkFanout(build_sinks(EXPORT_SINKS) + build_sinks(EXPORT_OPTIONAL_SINKS, required=False))
+
+        # 3. 状態管理テーブルの確認
+        ensure_state_table(bq_client, DATASET_ID, STATE_TABLE_NAME)
+        if part_start is None:
+            # シャード指定のない通常実行は、前回途中で終了した実行の続きのパート番号から始める
+            # (シャードの続きは呼び出し側のワークフローが next_part_start を渡す)
+            part_start = 1 if shard else get_next_part_start(bq_client)
+
+        # 4. 更新のクエリ
+        query = build_diff_query(shard=shard)
+
         logger.info("BigQueryで変更をクエリ中(SQL側でハッシュ計算)...")
         query_job = bq_client.query(query)
         # iteratorを取得（list()で全件取得しない）
         rows_iterator = query_job.result()
 
         updates_chunk = []
+        chunk_state_updates = []
         state_updates = []
-        CHUNK_SIZE = 1000
-        part_num = 1
-
-        # CSV出力用フィールド定義
-        fieldnames = [
-            "race_code_uma_kol", "race_code_uma_jvd", "race_code_kol", "race_code_jvd", "keibajo_code_jvd", "keibajo_code_kol",
-            "hasso_date", "kaiji", "nichiji", "race_bango", "race_bango_num", "waku_kubun", "wakuban", "umaban", "umaban_num", "umaban_even",
-            "bamei", "seibetsu_code", "seibetsu_code_label", "barei", "barei_num", "futan_juryo", "futan_juryo_float",
-            "blinker_shiyo_kubun", "blinker_shiyo_kubun_label", "rating", "rating_float",
-            "banushimei", "banushimei_ryakusho", "ketto_toroku_bango_kol", "ketto1_f_hanshoku_toroku_bango", "ketto1_f_bamei",
-            "ketto2_m_hanshoku_toroku_bango", "ketto2_m_bamei", "ketto5_mf_hanshoku_toroku_bango", "ketto5_mf_bamei", "kyuyo_riyu",
-            "kishumei", "kishumei_ryakusho", "kishu_code", "kishu_tozai_shozoku_code", "kishu_tozai_shozoku_code_label",
-            "kishu_minarai_code", "kishu_minarai_code_label", "kishu_norikawari_kubun", "kishu_norikawari_kubun_label",
-            "kishu_shozokubasho_code", "kishu_shozokubasho_code_label", "kishu_shozoku_chokyoshi_code",
-            "chokyoshi_code", "chokyoshimei", "chokyoshimei_ryakusho", "chokyoshi_shozokubasho_code", "chokyoshi_shozokubasho_code_label",
-            "chokyoshi_tracen_kubun", "chokyoshi_tracen_kubun_label",
-            "chokyo_flag", "chokyo_flag_label", "chokyo_kijosha", "chokyo_kijosha_equal_kishumei_flag", "chokyo_nengappi", "chokyo_nengappi_label", "chokyo_nengappi_date",
-            "chokyo_basho", "chokyo_course", "chokyo_course_kubun", "chokyo_basho_course_label", "chokyo_babajotai", "chokyo_hanro_pool_kaisu_int",
-            "chokyo_8f", "chokyo_8f_float", "chokyo_7f", "chokyo_7f_float", "chokyo_6f", "chokyo_6f_float", "chokyo_5f", "chokyo_5f_float",
-            "chokyo_4f", "chokyo_4f_float", "chokyo_3f", "chokyo_3f_float", "chokyo_2f_float", "chokyo_1f", "chokyo_1f_float",
-            "chokyo_lap_8f", "chokyo_lap_7f", "chokyo_lap_6f", "chokyo_lap_5f", "chokyo_lap_4f", "chokyo_lap_3f", "chokyo_lap_2f", "chokyo_lap_group",
-            "shirushi_hanro_4f_flag", "shirushi_hanro_1f_flag", "shirushi_wood_6f_flag", "shirushi_wood_1f_flag",
-            "shirushi_point", "shirushi_kubun_yosou_tansho_ninkijun", "shirushi_kubun_rank", "shirushi_shirushi_label", "shirushi_shirushi_num",
-            "chokyo_ichidori", "chokyo_ichidori_label", "chokyo_ashiiro", "chokyo_ashiiro_label", "chokyo_yajirushi", "chokyo_yajirushi_label",
-            "chokyo_reigai", "chokyo_awase", "chokyo_awase_kubun", "chokyo_awase_flag", "chokyo_awase_flag_label", "chokyo_tanpyo",
-            "chokyo_honsu_course", "chokyo_honsu_course_num", "chokyo_honsu_hanro", "chokyo_honsu_hanro_num", "chokyo_honsu_pool", "chokyo_honsu_pool_num",
-            "speed_sisu_last_1", "speed_sisu_last_1_float", "speed_sisu_last_2", "speed_sisu_last_2_float", "speed_sisu_last_3", "speed_sisu_last_3_float",
-            "speed_sisu_last_4", "speed_sisu_last_4_float", "speed_sisu_last_5", "speed_sisu_last_5_float",
-            "rotation1", "rotation1_label", "rotation2", "rotation2_label", "rotation3", "rotation3_label", "rotation4", "rotation4_label",
-            "rotation5", "rotation5_label", "rotation6", "rotation6_label", "rotation7", "rotation7_label", "rotation8", "rotation8_label", "zensou_kankaku",
-            "bataiju", "bataiju_kubun", "bataiju_zensou", "bataiju_kubun_zensou", "kyori_kubun_zensou", "kyori_extension_flag", "kyori_shortening_flag",
-            "ensei_kansai_to_kantou_flag", "ensei_kantou_to_kansai_flag", "ensei_flag", "track_code1_label_dirtsiba_zensou", "siba_to_dirt_flag", "dirt_to_siba_flag",
-            "record_shisu", "record_shisu_num", "zogen_sa", "zogen_sa_num", "tansho_ninkijun", "tansho_ninkijun_num", "tansho_odds", "tansho_odds_float",
-            "kakutei_chakujun", "kakutei_chakujun_num", "tansho_haraimodoshi", "tansho_haraimodoshi_num", "fukusho_haraimodoshi", "fukusho_haraimodoshi_num",
-            "ijo_kubun_code1", "ijo_kubun_code1_label", "ijo_kubun_code2", "ijo_kubun_code2_label", "nyusen_juni", "nyusen_juni_num", "record_flag", "record_flag_label",
-            "soha_time", "soha_time_float", "soha_time_label", "chakusa_code1", "chakusa_code1_num", "chakusa_code2", "chakusa_code2_label", "chakusa_label",
-            "time_sa", "time_sa_float", "zenhan_3f", "zenhan_3f_float", "kohan_3f", "kohan_3f_float",
-            "corner1_juni", "corner1_juni_label", "corner2_juni", "corner2_juni_label", "corner3_juni", "corner3_juni_label", "corner4_juni", "corner4_juni_label", "corner4_ichidori", "corner4_ichidori_label",
-            "race_name", "kyori_kubun", "keibajo_name", "chuo_chiho_kubun", "chuo_chiho_kubun_label", "kyosomei_15moji", "kyosomei_7moji",
-            "grade_code", "grade_code_label", "jpn_flag", "jpn_flag_label", "bettei_barei_handicap_summary_code", "bettei_barei_handicap_summary_code_label", "bettei_barei_handicap_detail",
-            "kyoso_joken_age_limit", "kyoso_joken_age_limit_label", "kyoso_joken_kubun", "kyoso_joken_kubun_label", "heichi_shogai_kubun", "heichi_shogai_kubun_label",
-            "track_code1_dirtsiba", "track_code1_dirtsiba_label", "track_code2_LRS", "track_code2_LRS_label", "track_code3_inout", "track_code3_inout_label",
-            "course_kubun", "course_kubun_label", "kyori", "toroku_tosu_num", "torikeshi_tosu_num", "tenko_code", "tenko_code_label",
-            "babajotai_code", "babajotai_code_label", "pace_yosou", "pace_yosou_label", "pace_kekka", "pace_kekka_label", "race_tanpyo",
-            "juryo_handicap_flag", "keibajo_komawari_curve4_flag", "keibajo_omawari_curve4_flag", "keibajo_straight_short_flag", "keibajo_straight_long_flag",
-            "created", "modified"
-        ]
+        part_num = part_start
+        partial = False
+        run_tag = build_run_tag()
+
+        def deadline_reached():
+            """経過時間が期限を超えたかを確認する"""
+            return deadline_seconds is not None and time.monotonic() - started_at >= deadline_seconds
 
         def upload_chunk(chunk, current_part_num):
-            """チャンクデータをFTPにアップロードする内部関数"""
+            """チャンクデータを全送信先にアップロードする内部関数。必須の送信先が全て受信した場合にTrueを返す"""
             if not chunk:
-                return
+                return True
 
             # 日付範囲の特定
             chunk_dates = []
@@ -162,119 +752,96 @@ def export_race_uma_details(request):
             c_min = min(chunk_dates)
             c_max = max(chunk_dates)
             table_name = "race_uma_details"
-            filename = f"{table_name}_{c_min}_{c_max}_part{current_part_num:03d}.csv"
+            filename = f"{table_name}_{c_min}_{c_max}{build_shard_tag(shard)}{run_tag}_part{current_part_num:03d}.csv"
 
-            logger.info(f"FTPへアップロード中... ({filename}, {len(chunk)} rows)")
-            try:
-                with ftplib.FTP(FTP_HOST) as ftp:
-                    ftp.login(user=ftp_user, passwd=ftp_pass)
-                    csv_buffer = io.StringIO()
-                    writer = csv.DictWriter(csv_buffer, fieldnames=fieldnames)
-                    writer.writeheader()
-                    writer.writerows(chunk)
-                    # ディレクトリ移動
-                    ftp_directory = os.environ.get("FTP_DIRECTORY")
-                    if ftp_directory:
-                        try:
-                            ftp.cwd(ftp_directory)
-                        except ftplib.error_perm:
-                            logger.info(f"ディレクトリ {ftp_directory} が存在しないため作成します。")
-                            ftp.mkd(ftp_directory)
-                            ftp.cwd(ftp_directory)
-                    csv_content = csv_buffer.getvalue().encode('utf-8')
-                    bio = io.BytesIO(csv_content)
-                    ftp.storbinary(f"STOR {filename}", bio)
-                    logger.info(f"{filename} のアップロード完了")
-            except Exception as e:
-                logger.error(f"FTPアップロードエラー: {filename}, {e}")
-                # 再送ロジックを入れるか、ここではエラーとして処理を継続するか
-                # 今回はログを出して再送せず、例外を送出して止める
-                raise e
+            # CSVは1回だけ生成し、同じバイト列を全送信先に送る
+            logger.info(f"アップロード中... ({filename}, {len(chunk)} rows)")
+            if not fanout.put(filename, build_csv(chunk)):
+                return False
+            logger.info(f"{filename} のアップロード完了")
+            return True
 
         processed_count = 0
 
-        # イテレータを回してストリーミング処理
-        for row in rows_iterator:
-            # Rowデータを辞書化
-            row_data = {field: row[field] for field in fieldnames}
-
-            # ハッシュ
-            current_hash = row["current_hash"]
-
-            # バッファに追加
-            updates_chunk.append(row_data)
-            # 状態更新用
-            state_updates.append({
-                "race_code_uma_jvd": row_data["race_code_uma_jvd"],
-                "content_hash": current_hash
-            })
-
-            # チャンクサイズに達したらアップロード
-            if len(updates_chunk) >= CHUNK_SIZE:
-                upload_chunk(updates_chunk, part_num)
-                processed_count += len(updates_chunk)
-                updates_chunk = [] # バッファクリア
-                part_num += 1
-
-        # 残りのチャンクがあればアップロード
-        if updates_chunk:
-            upload_chunk(updates_chunk, part_num)
-            processed_count += len(updates_chunk)
+        try:
+            # イテレータを回してストリーミング処理
+            for row in rows_iterator:
+                # Rowデータを辞書化
+                row_data = {field: row[field] for field in FIELDNAMES}
+
+                # ハッシュ
+                current_hash = row["current_hash"]
+
+                # バッファに追加
+                updates_chunk.append(row_data)
+                # 状態更新用 (アップロード済みのパートのみ状態管理テーブルに反映する)
+                chunk_state_updates.append({
+                    "race_code_uma_jvd": row_data["race_code_uma_jvd"],
+                    "content_hash": current_hash
+                })
+
+                # チャンクサイズに達したらアップロード
+                if len(updates_chunk) >= CHUNK_SIZE:
+                    # 期限を過ぎていれば新しいパートを取らずに打ち切る (進捗を保証するため最初のパートは必ず送る)
+                    if processed_count and deadline_reached():
+                        partial = True
+                        break
+                    if not upload_chunk(updates_chunk, part_num):
+                        break
+                    processed_count += len(updates_chunk)
+                    state_updates.extend(chunk_state_updates)
+                    updates_chunk = [] # バッファクリア
+                    chunk_state_updates = []
+                    part_num += 1
+
+            # 残りのチャンクがあればアップロード
+            if updates_chunk and not partial and fanout.required_succeeded():
+                if processed_count and deadline_reached():
+                    partial = True
+                elif upload_chunk(updates_chunk, part_num):
+                    processed_count += len(updates_chunk)
+                    state_updates.extend(chunk_state_updates)
+                    part_num += 1
+        finally:
+            fanout.close()
+
+        logger.info(f"送信先ごとの結果: {fanout.results()}")
+
+        # 7. 状態管理テーブルの更新 (state_updatesはメモリに残っている前提)
+        # 必須の送信先が全て受信したパートの状態は、途中で失敗しても反映する(次回は未受信の行のみ再送する)
+        merge_state_updates(bq_client, state_updates)
+
+        if not shard and (partial or not fanout.required_succeeded()) and part_num > part_start:
+            # 通常実行の続きは part_start を指定しない呼び出しでも、送信済みのパートの次の番号から始める
+            set_next_part_start(bq_client, part_num)
+
+        if not fanout.required_succeeded():
+            logger.error(f"アップロードに失敗しました: {fanout.errors}")
+            return f"アップロード失敗: {fanout.errors}", 500
+        if fanout.errors:
+            # 任意の送信先の失敗は再送しない
+            logger.warning(f"任意の送信先へのアップロードに失敗しました: {fanout.errors}")
 
         logger.info(f"合計 {processed_count} 件をエクスポートしました。")
 
         if processed_count == 0:
+             if not shard:
+                 set_export_watermark(bq_client, source_modified_ms)
              return "更新はありませんでした。", 200
 
-        # 7. 状態管理テーブルの更新 (state_updatesはメモリに残っている前提)
-        # 数十万件の場合はここでもメモリ不足になる可能性があるため、state_updatesもチャンク分割して一時テーブルにロード推奨だが
-        # まずは8GBメモリを信じて一括ロードを試みる
-        logger.info(f"状態管理テーブルを更新中... ({len(state_updates)} updates)")
-        if state_updates:
-            # MERGEを使用して状態をUPSERT
-
-            # 挿入用データの準備
-            rows_to_insert = [
-                {
-                    "race_code_uma_jvd": u["race_code_uma_jvd"],
-                    "content_hash": u["content_hash"],
-                    "exported_at": datetime.datetime.now().isoformat()
-                }
-                for u in state_updates
-            ]
-
-            # 1. 一時テーブルへのロード (JSONロードは大量データに弱い場合があるが、hashとIDだけなら耐えられるか)
-            job_config = bigquery.LoadJobConfig(
-                write_disposition="WRITE_TRUNCATE",
-                schema=[
-                    bigquery.SchemaField("race_code_uma_jvd", "STRING"),
-                    bigquery.SchemaField("content_hash", "STRING"),
-                    bigquery.SchemaField("exported_at", "TIMESTAMP"),
-                ]
-            )
-            temp_table_id = f"{PROJECT_ID}.{DATASET_ID}.temp_race_uma_details_state_updates"
-
-            # チャンク分割してロードすることを検討すべきだが、コード簡略化のため一括
-            # JSON Lines ファイルをGCSに書いてロードするのがベストプラクティスだが、ここでは直接ロード
-            load_job = bq_client.load_table_from_json(rows_to_insert, temp_table_id, job_config=job_config)
-            load_job.result() # 待機
-
-            # 2. マージ実行
-            merge_query = f"""
-                MERGE `{PROJECT_ID}.{DATASET_ID}.{STATE_TABLE_NAME}` T
-                USING `{temp_table_id}` S
-                ON T.race_code_uma_jvd = S.race_code_uma_jvd
-                WHEN MATCHED THEN
-                  UPDATE SET content_hash = S.content_hash, exported_at = S.exported_at
-                WHEN NOT MATCHED THEN
-                  INSERT (race_code_uma_jvd, content_hash, exported_at)
-                  VALUES (race_code_uma_jvd, content_hash, exported_at)
-            """
-            bq_client.query(merge_query).result()
-            logger.info("状態管理テーブルが更新されました。")
-
-            # 一時テーブルの削除
-            bq_client.delete_table(temp_table_id, not_found_ok=True)
+        if partial:
+            # 期限により打ち切った場合は、残りを次回の呼び出しで処理する (ウォーターマークは進めない)
+            logger.info(f"期限 {deadline_seconds} 秒に達したため、{processed_count} 行で打ち切りました。次回はパート {part_num} から継続します。")
+            return {
+                "status": "partial",
+                "exported_rows": processed_count,
+                "next_part_start": part_num,
+                "message": f"期限に達したため一部のみエクスポートしました。 {processed_count} 行をエクスポートしました。",
+            }, 200
+
+        # シャード単位の実行はテーブル全体をカバーしないため、ウォーターマークを進めない
+        if not shard:
+            set_export_watermark(bq_client, source_modified_ms)
 
         return f"成功。 {processed_count} 行をエクスポートしました。", 200
 
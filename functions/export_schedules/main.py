@@ -5,9 +5,11 @@ import io
 import json
 import logging
 import ftplib
+from concurrent.futures import ThreadPoolExecutor
 import functions_framework
 from google.cloud import bigquery
 from google.cloud import secretmanager
+from google.cloud import storage
 import datetime
 
 # ログ設定
@@ -20,7 +22,15 @@ DATASET_ID = os.environ.get("DATASET_ID") # 例: kolbi_analysis または kolbi_
 SECRET_USER = os.environ.get("SECRET_USER") # ユーザー名のシークレットリソースID
 SECRET_PASS = os.environ.get("SECRET_PASS") # パスワードのシークレットリソースID
 STATE_TABLE_NAME = "schedules_export_state"
+SOURCE_TABLE_NAME = "schedule" # エクスポート元のマートテーブル
+WATERMARK_LABEL = "last_source_modified_ms" # 状態管理テーブルに記録する前回エクスポート時のソース最終更新時刻
 FTP_HOST = "smartkb.mixh.jp"
+EXPORT_SINKS = os.environ.get("EXPORT_SINKS", "ftp") # 送信先(カンマ区切り) 例: ftp,gcs:bucket/prefix,local:/tmp/export
+EXPORT_OPTIONAL_SINKS = os.environ.get("EXPORT_OPTIONAL_SINKS", "") # 失敗しても再送しない送信先(形式は EXPORT_SINKS と同じ)
+CHUNK_SIZE = 1000
+
+# CSV出力用フィールド定義 (スキーマに合わせたフィールド順序)
+FIELDNAMES = ["id", "year", "month_day", "period1_start", "period2_end", "modified", "created"]
 
 def get_secret(secret_id):
     """Secret Managerからシークレット値を取得する"""
@@ -54,38 +64,318 @@ def calculate_hash(row):
     row_str = json.dumps(dict(row), sort_keys=True, default=str)
     return hashlib.sha256(row_str.encode('utf-8')).hexdigest()
 
-@functions_framework.http
-def export_schedules(request):
-    """更新されたスケジュールをFTPにエクスポートするHTTP Cloud Function"""
-    try:
-        # 1. クライアントの初期化
-        bq_client = bigquery.Client(project=PROJECT_ID)
-
-        # 2. FTP認証情報の取得
-        logger.info("FTP認証情報を取得中...")
-        ftp_user = get_secret(SECRET_USER)
-        ftp_pass = get_secret(SECRET_PASS)
-
-        # 3. 状態管理テーブルの確認
-        ensure_state_table(bq_client, DATASET_ID, STATE_TABLE_NAME)
+class FtpSink:
+    """FTPサーバーへの送信先"""
+
+    def __init__(self, host, user, password, directory=None):
+        self.name = f"ftp:{host}"
+        self.host = host
+        self.user = user
+        self.password = password
+        self.directory = directory
+        self.ftp = None
+
+    def open(self):
+        self.ftp = ftplib.FTP(self.host)
+        self.ftp.login(user=self.user, passwd=self.password)
+
+        # ディレクトリ移動
+        if self.directory:
+            try:
+                self.ftp.cwd(self.directory)
+                logger.info(f"FTPディレクトリを {self.directory} に変更しました。")
+            except ftplib.error_perm as e:
+                logger.warning(f"ディレクトリ {self.directory} への移動に失敗しました: {e}。ルートディレクトリを使用します。")
+
+    def put(self, filename, data):
+        self.ftp.storbinary(f"STOR {filename}", io.BytesIO(data))
+
+    def close(self):
+        if self.ftp is not None:
+            try:
+                self.ftp.quit()
+            except Exception:
+                self.ftp.close()
+            self.ftp = None
+
+class GcsSink:
+    """GCSバケットへの送信先"""
+
+    def __init__(self, bucket_name, prefix=""):
+        self.name = f"gcs:{bucket_name}/{prefix}".rstrip("/")
+        self.bucket_name = bucket_name
+        self.prefix = prefix.strip("/")
+        self.bucket = None
+
+    def open(self):
+        self.bucket = storage.Client(project=PROJECT_ID).bucket(self.bucket_name)
+
+    def put(self, filename, data):
+        blob_name = f"{self.prefix}/{filename}" if self.prefix else filename
+        self.bucket.blob(blob_name).upload_from_string(data, content_type="text/csv")
+
+    def close(self):
+        self.bucket = None
+
+class LocalDirSink:
+    """ローカルディレクトリへの送信先(動作確認用)"""
+
+    def __init__(self, path):
+        self.name = f"local:{path}"
+        self.path = path
+
+    def open(self):
+        os.makedirs(self.path, exist_ok=True)
+
+    def put(self, filename, data):
+        with open(os.path.join(self.path, filename), "wb") as f:
+            f.write(data)
+
+    def close(self):
+        pass
+
+def build_sinks(spec, required=True):
+    """EXPORT_SINKS / EXPORT_OPTIONAL_SINKS の設定(カンマ区切り)から送信先を生成する
+
+    required=False の送信先は失敗しても状態管理テーブルの更新を妨げない(未受信のパートは再送されない)。
+
+    ftp                   : FTP_HOST の FTP_DIRECTORY (認証情報はSecret Managerから取得)
+    gcs:<bucket>[/<prefix>]: GCSバケット
+    local:<path>          : ローカルディレクトリ
+    """
+    sinks = []
+    for entry in (s.strip() for s in spec.split(",")):
+        if not entry:
+            continue
+        kind, _, target = entry.partition(":")
+        if kind == "ftp":
+            logger.info("FTP認証情報を取得中...")
+            ftp_user = get_secret(SECRET_USER)
+            ftp_pass = get_secret(SECRET_PASS)
+            sinks.append(FtpSink(FTP_HOST, ftp_user, ftp_pass, os.environ.get("FTP_DIRECTORY")))
+        elif kind == "gcs":
+            bucket_name, _, prefix = target.partition("/")
+            sinks.append(GcsSink(bucket_name, prefix))
+        elif kind == "local":
+            sinks.append(LocalDirSink(target))
+        else:
+            raise ValueError(f"未対応の送信先です: {entry}")
+    if required and not sinks:
+        raise ValueError("EXPORT_SINKS に送信先が設定されていません。")
+    for sink in sinks:
+        sink.required = required
+    return sinks
+
+class SinkFanout:
+    """シリアライズ済みの1パートを、同じバイト列のまま複数の送信先へ並列に送信する
+
+    送信先ごとに成功・失敗を記録し、失敗した送信先には以降のパートを送らない。
+    必須の送信先が1つでも失敗した時点で送信を打ち切る。
+    送信先は最初のパート送信時に接続する(更新がない場合は接続しない)。
+    """
+
+    def __init__(self, sinks):
+        self.sinks = sinks
+        self.uploaded = {sink.name: 0 for sink in sinks}
+        self.errors = {}
+        self.opened = False
+        self.executor = ThreadPoolExecutor(max_workers=len(sinks))
+
+    def active_sinks(self):
+        return [sink for sink in self.sinks if sink.name not in self.errors]
+
+    def _run(self, method, *args):
+        """送信可能な送信先でメソッドを並列実行し、成功した送信先を返す"""
+        futures = [(sink, self.executor.submit(getattr(sink, method), *args)) for sink in self.active_sinks()]
+        succeeded = []
+        for sink, future in futures:
+            try:
+                future.result()
+                succeeded.append(sink)
+            except Exception as e:
+                logger.error(f"送信先 {sink.name} でエラーが発生しました ({method}): {e}")
+                self.errors[sink.name] = str(e)
+        return succeeded
+
+    def put(self, filename, data):
+        """全送信先へ送信する。必須の送信先が全て受信した場合にTrueを返す"""
+        if not self.opened:
+            self._run("open")
+            self.opened = True
+        for sink in self._run("put", filename, data):
+            self.uploaded[sink.name] += 1
+        return self.required_succeeded()
+
+    def close(self):
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except Exception as e:
+                logger.warning(f"送信先 {sink.name} のクローズに失敗しました: {e}")
+        self.executor.shutdown()
+
+    def required_succeeded(self):
+        return not any(sink.required and sink.name in self.errors for sink in self.sinks)
+
+    def results(self):
+        """送信先ごとのアップロード済みパート数とエラー"""
+        return {
+            sink.name: {
+                "required": sink.required,
+                "uploaded_parts": self.uploaded[sink.name],
+                "error": self.errors.get(sink.name),
+            }
+            for sink in self.sinks
+        }
 
-        # 4. 更新のクエリ
-        # ロジック:
-        # - 現在の全てのスケジュールを取得
-        # - 状態管理テーブルと左外部結合
-        # - 状態がNULL（新規）またはハッシュが異なる（更新）行をフィルタリング
+def state_table_exists(bq_client, dataset_id, table_name):
+    """状態管理テーブルが存在するかを確認する(作成はしない)"""
+    try:
+        bq_client.get_table(f"{PROJECT_ID}.{dataset_id}.{table_name}")
+        return True
+    except Exception:
+        return False
+
+def get_request_params(request):
+    """クエリパラメータとJSONボディをまとめて辞書として取得する(ボディ優先)"""
+    params = dict(request.args) if request.args else {}
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        params.update(body)
+    return params
+
+def parse_bool(value):
+    """リクエストパラメータの真偽値を解釈する"""
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ("1", "true", "yes", "on")
+
+def parse_epoch_ms(value):
+    """last_modified_time(エポックミリ秒またはISO 8601文字列)をエポックミリ秒に変換する"""
+    if value is None or value == "":
+        return None
+    if isinstance(value, bool):
+        raise ValueError(f"真偽値は時刻として扱えません: {value}")
+    if isinstance(value, (int, float)):
+        return int(value)
+    value = str(value).strip()
+    if value.isdigit():
+        return int(value)
+    dt = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return int(dt.timestamp() * 1000)
+
+def get_source_modified_ms(bq_client):
+    """ソースマートの最終更新時刻(エポックミリ秒)をテーブルのメタデータから取得する(クエリは発行しない)"""
+    table = bq_client.get_table(f"{PROJECT_ID}.{DATASET_ID}.{SOURCE_TABLE_NAME}")
+    return int(table.modified.timestamp() * 1000)
+
+def get_reported_modified_ms(params):
+    """ペイロードの tables.<テーブル名>.last_modified_time (呼び出し元が申告した最終更新時刻)を返す(指定なしの場合はNone)"""
+    table_info = (params.get("tables") or {}).get(SOURCE_TABLE_NAME) or {}
+    return parse_epoch_ms(table_info.get("last_modified_time"))
+
+def get_export_watermark(bq_client):
+    """前回エクスポート成功時のソースマート最終更新時刻を状態管理テーブルのラベルから取得する"""
+    try:
+        table = bq_client.get_table(f"{PROJECT_ID}.{DATASET_ID}.{STATE_TABLE_NAME}")
+    except Exception:
+        return None
+    value = (table.labels or {}).get(WATERMARK_LABEL)
+    return int(value) if value else None
+
+def set_export_watermark(bq_client, modified_ms):
+    """エクスポート成功時のソースマート最終更新時刻を状態管理テーブルのラベルに記録する"""
+    table = bq_client.get_table(f"{PROJECT_ID}.{DATASET_ID}.{STATE_TABLE_NAME}")
+    table.labels = {**(table.labels or {}), WATERMARK_LABEL: str(modified_ms)}
+    bq_client.update_table(table, ["labels"])
+
+def validate_dataform_params(params):
+    """dataform_actions / tables の形式を検証する(不正な場合はValueError)"""
+    actions = params.get("dataform_actions")
+    if actions is not None:
+        if not isinstance(actions, list) or not all(
+            isinstance(a, dict) and isinstance(a.get("target") or {}, dict) for a in actions
+        ):
+            raise ValueError("dataform_actions は workflowInvocationActions と同じ形式のオブジェクトの配列で指定してください。")
+    tables = params.get("tables")
+    if tables is not None:
+        if not isinstance(tables, dict) or not all(isinstance(t, dict) for t in tables.values()):
+            raise ValueError('tables は {"テーブル名": {"last_modified_time": ...}} の形式で指定してください。')
+        now_ms = int(datetime.datetime.now(datetime.timezone.utc).timestamp() * 1000)
+        for table_info in tables.values():
+            try:
+                modified_ms = parse_epoch_ms(table_info.get("last_modified_time"))
+            except (TypeError, ValueError):
+                raise ValueError(f"last_modified_time はエポックミリ秒またはISO 8601で指定してください: {table_info}")
+            if modified_ms is not None and modified_ms > now_ms:
+                raise ValueError(f"last_modified_time に未来の時刻は指定できません: {table_info}")
+
+def get_skip_reason(bq_client, params):
+    """ソースマートが前回のエクスポート以降に再構築されていなければ、スキップ理由を返す(再構築済みならNone)
+
+    判定はソースマートの最終更新時刻とウォーターマークの比較を優先する。
+    アップロード失敗などでウォーターマークが遅れている場合は、Dataformの実行対象でなくても再試行する。
+    Workflowsは読み込まれたテーブルに依存するマートだけをDataformで再構築するため、
+    実行対象外のマートは最終更新時刻が進まず、ここでスキップされる。
+    ウォーターマークがない場合のみ、Dataformのアクションで判定する。
+
+    dataform_actions: Dataform workflowInvocations.query の workflowInvocationActions
+    tables: {テーブル名: {"last_modified_time": ...}} (比較にのみ使い、ウォーターマークには記録しない)
+    """
+    watermark = get_export_watermark(bq_client)
+    if watermark is not None:
+        modified_ms = get_reported_modified_ms(params)
+        if modified_ms is None:
+            modified_ms = get_source_modified_ms(bq_client)
+        if modified_ms <= watermark:
+            return f"{SOURCE_TABLE_NAME} は前回のエクスポート以降に再構築されていません。"
+        return None
+
+    actions = params.get("dataform_actions")
+    if actions is not None:
+        action = next(
+            (a for a in actions
+             if (a.get("target") or {}).get("name") == SOURCE_TABLE_NAME
+             and (a.get("target") or {}).get("schema", DATASET_ID) == DATASET_ID),
+            None
+        )
+        if action is None:
+            return f"{SOURCE_TABLE_NAME} はDataformの実行対象に含まれていません。"
+        if action.get("state") != "SUCCEEDED":
+            return f"{SOURCE_TABLE_NAME} のDataformアクションの状態が {action.get('state')} です。"
+    return None
+
+def build_diff_query(state_available=True):
+    """現在のスケジュールと状態管理テーブルを結合するクエリを生成する
+
+    ロジック:
+    - 現在の全てのスケジュールを取得
+    - 状態管理テーブルと左外部結合
+    - 状態がNULL（新規）またはハッシュが異なる（更新）行をPython側でフィルタリング
+    状態管理テーブルが存在しない場合(ドライラン時)は空の状態として扱い、全件を差分とみなす。
+    """
+    if state_available:
+        state_source = f"""
+                SELECT
+                    schedule_id,
+                    content_hash
+                FROM `{PROJECT_ID}.{DATASET_ID}.{STATE_TABLE_NAME}`"""
+    else:
+        state_source = """
+                SELECT
+                    schedule_id,
+                    CAST(NULL AS STRING) AS content_hash
+                FROM UNNEST(ARRAY<STRING>[]) AS schedule_id"""
 
-        query = f"""
+    return f"""
             WITH CurrentSchedules AS (
                 SELECT
                     *
-                FROM `{PROJECT_ID}.{DATASET_ID}.schedule`
+                FROM `{PROJECT_ID}.{DATASET_ID}.{SOURCE_TABLE_NAME}`
             ),
-            State AS (
-                SELECT
-                    schedule_id,
-                    content_hash
-                FROM `{PROJECT_ID}.{DATASET_ID}.{STATE_TABLE_NAME}`
+            State AS ({state_source}
             )
             SELECT
                 c.*,
@@ -94,52 +384,185 @@ def export_schedules(request):
             LEFT JOIN State s ON c.id = s.schedule_id
         """
 
-        logger.info("BigQueryで変更をクエリ中...")
-        query_job = bq_client.query(query)
-        rows = list(query_job.result())
+def find_updates(rows):
+    """ハッシュを比較し、新規または変更された行と状態更新用データを返す"""
+    updates = []
+    state_updates = []
+
+    for row in rows:
+        # ハッシュ化のために行データを辞書として再構築
+        # sqlx定義に基づくschedulesのスキーマ: id, year, month_day, period1_start, period2_end, modified, created
+        row_data = {
+            "id": row["id"],
+            "year": row["year"],
+            "month_day": row["month_day"],
+            "period1_start": row["period1_start"],
+            "period2_end": row["period2_end"],
+            "modified": row["modified"],
+            "created": row["created"]
+        }
+
+        # ハッシュ計算用データ（タイムスタンプは毎回変わるため除外）
+        hash_data = {
+            "id": row["id"],
+            "year": row["year"],
+            "month_day": row["month_day"],
+            "period1_start": row["period1_start"],
+            "period2_end": row["period2_end"]
+        }
+
+        current_hash = calculate_hash(hash_data)
+        old_hash = row["old_hash"]
+
+        if old_hash is None or current_hash != old_hash:
+            updates.append(row_data)
+            state_updates.append({
+                "schedule_id": row_data["id"],
+                "content_hash": current_hash
+            })
+    return updates, state_updates
+
+def build_run_tag():
+    """ファイル名に付ける実行ごとのタグ(エクスポート開始時刻, UTC)
+
+    途中で失敗・打ち切りになった実行の残りの行を次回送る際に、送信済みのファイルを上書きしないようにする。
+    """
+    return datetime.datetime.now(datetime.timezone.utc).strftime("_%Y%m%dT%H%M%SZ")
+
+def build_csv(chunk):
+    """チャンクをヘッダー付きCSVのバイト列に変換する"""
+    csv_buffer = io.StringIO()
+    writer = csv.DictWriter(csv_buffer, fieldnames=FIELDNAMES)
+    writer.writeheader()
+    writer.writerows(chunk)
+    return csv_buffer.getvalue().encode('utf-8')
+
+def estimate_export(bq_client, query):
+    """アップロードや状態更新を行わずに、エクスポート規模を見積もる
+
+    差分判定はPython側のハッシュで行うため、BigQueryのドライランでスキャンバイト数を取得した上で
+    クエリを実行し、差分行を実際にCSV化したサイズを返す。scheduleテーブルは小さいため実行コストは小さい。
+    """
+    dry_run_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+    dry_run_job = bq_client.query(query, job_config=dry_run_config)
+
+    updates, _ = find_updates(bq_client.query(query).result())
+    chunks = [updates[i:i + CHUNK_SIZE] for i in range(0, len(updates), CHUNK_SIZE)]
+    return {
+        "dry_run": True,
+        "estimated_scan_bytes": dry_run_job.total_bytes_processed,
+        "changed_rows": len(updates),
+        "part_count": len(chunks),
+        "chunk_size": CHUNK_SIZE,
+        "estimated_payload_bytes": sum(len(build_csv(chunk)) for chunk in chunks),
+    }
+
+def merge_state_updates(bq_client, state_updates):
+    """送信済みの行のハッシュを一時テーブル経由で状態管理テーブルにMERGEする"""
+    if not state_updates:
+        return
+    logger.info(f"状態管理テーブルを更新中... ({len(state_updates)} updates)")
+    # MERGEを使用して状態をUPSERT
+    # 挿入用データの準備
+    rows_to_insert = [
+        {
+            "schedule_id": u["schedule_id"],
+            "content_hash": u["content_hash"],
+            "exported_at": datetime.datetime.now().isoformat()
+        }
+        for u in state_updates
+    ]
 
-        updates = []
-        state_updates = []
-
-        for row in rows:
-            # ハッシュ化のために行データを辞書として再構築
-            # sqlx定義に基づくschedulesのスキーマ: id, year, month_day, period1_start, period2_end, modified, created
-            row_data = {
-                "id": row["id"],
-                "year": row["year"],
-                "month_day": row["month_day"],
-                "period1_start": row["period1_start"],
-                "period2_end": row["period2_end"],
-                "modified": row["modified"],
-                "created": row["created"]
-            }
+    # 1. 一時テーブルへのロード
+    job_config = bigquery.LoadJobConfig(
+        write_disposition="WRITE_TRUNCATE",
+        schema=[
+            bigquery.SchemaField("schedule_id", "STRING"),
+            bigquery.SchemaField("content_hash", "STRING"),
+            bigquery.SchemaField("exported_at", "TIMESTAMP"),
+        ]
+    )
+    temp_table_id = f"{PROJECT_ID}.{DATASET_ID}.temp_schedules_state_updates"
+    load_job = bq_client.load_table_from_json(rows_to_insert, temp_table_id, job_config=job_config)
+    load_job.result() # 待機
+
+    # 2. マージ実行
+    merge_query = f"""
+        MERGE `{PROJECT_ID}.{DATASET_ID}.{STATE_TABLE_NAME}` T
+        USING `{temp_table_id}` S
+        ON T.schedule_id = S.schedule_id
+        WHEN MATCHED THEN
+          UPDATE SET content_hash = S.content_hash, exported_at = S.exported_at
+        WHEN NOT MATCHED THEN
+          INSERT (schedule_id, content_hash, exported_at)
+          VALUES (schedule_id, content_hash, exported_at)
+    """
+    bq_client.query(merge_query).result()
+    logger.info("状態管理テーブルが更新されました。")
+
+    # 一時テーブルの削除
+    bq_client.delete_table(temp_table_id, not_found_ok=True)
 
-            # ハッシュ計算用データ（タイムスタンプは毎回変わるため除外）
-            hash_data = {
-                "id": row["id"],
-                "year": row["year"],
-                "month_day": row["month_day"],
-                "period1_start": row["period1_start"],
-                "period2_end": row["period2_end"]
-            }
 
-            current_hash = calculate_hash(hash_data)
-            old_hash = row["old_hash"]
+@functions_framework.http
+def export_schedules(request):
+    """更新されたスケジュールを送信先(既定はFTP)にエクスポートするHTTP Cloud Function
+
+    リクエストパラメータ:
+        dry_run: true の場合、アップロードと状態管理テーブルの更新を行わずに見積もりのみ返す
+        dataform_actions / tables: Dataformの実行結果。ソースマートが前回のエクスポート以降に
+            再構築されていない場合、差分クエリを発行せずに終了する
+    """
+    try:
+        # 1. クライアントの初期化
+        bq_client = bigquery.Client(project=PROJECT_ID)
+        params = get_request_params(request)
+        try:
+            validate_dataform_params(params)
+        except ValueError as e:
+            return f"不正なリクエストパラメータ: {e}", 400
+
+        # ドライラン: 状態管理テーブルを作成・更新せず、見積もりのみ返す
+        if parse_bool(params.get("dry_run", False)):
+            logger.info("ドライランモードで実行中...")
+            state_available = state_table_exists(bq_client, DATASET_ID, STATE_TABLE_NAME)
+            estimate = estimate_export(bq_client, build_diff_query(state_available))
+            logger.info(f"見積もり結果: {estimate}")
+            return estimate, 200
+
+        # 選択的エクスポート: ソースマートが再構築されていなければクエリを発行せずに終了
+        if params.get("dataform_actions") is not None or params.get("tables") is not None:
+            skip_reason = get_skip_reason(bq_client, params)
+            if skip_reason:
+                logger.info(f"エクスポートをスキップします: {skip_reason}")
+                return f"スキップしました。{skip_reason}", 200
+
+        # ウォーターマークには呼び出し元の申告値ではなく、テーブルのメタデータの最終更新時刻を記録する
+        # 最終更新時刻はクエリ前に取得し、実行中に再構築された場合は次回再度エクスポートされるようにする
+        source_modified_ms = get_source_modified_ms(bq_client)
+
+        # 2. 送信先の初期化 (FTP認証情報の取得を含む)
+        fanout = SinkFanout(build_sinks(EXPORT_SINKS) + build_sinks(EXPORT_OPTIONAL_SINKS, required=False))
+
+        # 3. 状態管理テーブルの確認
+        ensure_state_table(bq_client, DATASET_ID, STATE_TABLE_NAME)
+
+        # 4. 更新のクエリ
+        query = build_diff_query()
+
+        logger.info("BigQueryで変更をクエリ中...")
+        query_job = bq_client.query(query)
+        rows = list(query_job.result())
 
-            if old_hash is None or current_hash != old_hash:
-                updates.append(row_data)
-                state_updates.append({
-                    "schedule_id": row_data["id"],
-                    "content_hash": current_hash
-                })
+        updates, state_updates = find_updates(rows)
 
         logger.info(f"{len(updates)} 件の更新が見つかりました。")
 
         if not updates:
+            set_export_watermark(bq_client, source_modified_ms)
             return "更新はありませんでした。", 200
 
-        # 5. CSV生成とFTPアップロード
-        CHUNK_SIZE = 1000
+        # 5. CSV生成とアップロード
         table_name = "schedule"
 
         # 更新データ(updates)からMin/Maxの日付(id)を取得
@@ -152,92 +575,47 @@ def export_schedules(request):
         chunks = [updates[i:i + CHUNK_SIZE] for i in range(0, len(updates), CHUNK_SIZE)]
         total_parts = len(chunks)
 
-        logger.info(f"FTPホスト {FTP_HOST} へアップロード中... (合計 {len(updates)} 件 - {total_parts} ファイル)")
+        logger.info(f"{', '.join(s.name for s in fanout.sinks)} へアップロード中... (合計 {len(updates)} 件 - {total_parts} ファイル)")
 
+        run_tag = build_run_tag()
+        exported_state_updates = []
         try:
-            with ftplib.FTP(FTP_HOST) as ftp:
-                ftp.login(user=ftp_user, passwd=ftp_pass)
-
-                # ディレクトリ移動
-                ftp_directory = os.environ.get("FTP_DIRECTORY")
-                if ftp_directory:
-                    try:
-                        ftp.cwd(ftp_directory)
-                        logger.info(f"FTPディレクトリを {ftp_directory} に変更しました。")
-                    except ftplib.error_perm as e:
-                        logger.warning(f"ディレクトリ {ftp_directory} への移動に失敗しました: {e}。ルートディレクトリを使用します。")
-
-                for i, chunk in enumerate(chunks):
-                    # ファイル名の生成
-                    if total_parts > 1:
-                        # 分割あり: {table_name}_{from}_{to}_part{NNN}.csv
-                        part_num = i + 1
-                        filename = f"{table_name}_{min_date}_{max_date}_part{part_num:03d}.csv"
-                    else:
-                        # 分割なし: {table_name}_{from}_{to}.csv
-                        filename = f"{table_name}_{min_date}_{max_date}.csv"
-
-                    logger.info(f"CSVを生成中... ({filename})")
-                    csv_buffer = io.StringIO()
-                    # スキーマに合わせたフィールド順序
-                    fieldnames = ["id", "year", "month_day", "period1_start", "period2_end", "modified", "created"]
-                    writer = csv.DictWriter(csv_buffer, fieldnames=fieldnames)
-                    writer.writeheader()
-                    writer.writerows(chunk)
-                    csv_content = csv_buffer.getvalue().encode('utf-8')
-
-                    bio = io.BytesIO(csv_content)
-                    ftp.storbinary(f"STOR {filename}", bio)
-                    logger.info(f"{filename} のアップロードに成功しました。")
-
-        except Exception as e:
-            logger.error(f"FTPアップロードに失敗しました: {e}")
-            return f"FTPアップロード失敗: {e}", 500
+            for i, chunk in enumerate(chunks):
+                # ファイル名の生成
+                if total_parts > 1:
+                    # 分割あり: {table_name}_{from}_{to}_{実行タグ}_part{NNN}.csv
+                    part_num = i + 1
+                    filename = f"{table_name}_{min_date}_{max_date}{run_tag}_part{part_num:03d}.csv"
+                else:
+                    # 分割なし: {table_name}_{from}_{to}_{実行タグ}.csv
+                    filename = f"{table_name}_{min_date}_{max_date}{run_tag}.csv"
+
+                # CSVは1回だけ生成し、同じバイト列を全送信先に送る
+                logger.info(f"CSVを生成中... ({filename})")
+                csv_content = build_csv(chunk)
+
+                if not fanout.put(filename, csv_content):
+                    break
+                # updates と state_updates は同じ順序のため、同じ範囲を送信済みとして扱う
+                exported_state_updates.extend(state_updates[i * CHUNK_SIZE:(i + 1) * CHUNK_SIZE])
+                logger.info(f"{filename} のアップロードが完了しました。")
+        finally:
+            fanout.close()
+
+        logger.info(f"送信先ごとの結果: {fanout.results()}")
 
         # 7. 状態管理テーブルの更新
-        logger.info("状態管理テーブルを更新中...")
-        if state_updates:
-            # MERGEを使用して状態をUPSERT
-
-            # 挿入用データの準備
-            rows_to_insert = [
-                {
-                    "schedule_id": u["schedule_id"],
-                    "content_hash": u["content_hash"],
-                    "exported_at": datetime.datetime.now().isoformat()
-                }
-                for u in state_updates
-            ]
-
-            # 1. 一時テーブルへのロード
-            job_config = bigquery.LoadJobConfig(
-                write_disposition="WRITE_TRUNCATE",
-                schema=[
-                    bigquery.SchemaField("schedule_id", "STRING"),
-                    bigquery.SchemaField("content_hash", "STRING"),
-                    bigquery.SchemaField("exported_at", "TIMESTAMP"),
-                ]
-            )
-            temp_table_id = f"{PROJECT_ID}.{DATASET_ID}.temp_schedules_state_updates"
-            load_job = bq_client.load_table_from_json(rows_to_insert, temp_table_id, job_config=job_config)
-            load_job.result() # 待機
-
-            # 2. マージ実行
-            merge_query = f"""
-                MERGE `{PROJECT_ID}.{DATASET_ID}.{STATE_TABLE_NAME}` T
-                USING `{temp_table_id}` S
-                ON T.schedule_id = S.schedule_id
-                WHEN MATCHED THEN
-                  UPDATE SET content_hash = S.content_hash, exported_at = S.exported_at
-                WHEN NOT MATCHED THEN
-                  INSERT (schedule_id, content_hash, exported_at)
-                  VALUES (schedule_id, content_hash, exported_at)
-            """
-            bq_client.query(merge_query).result()
-            logger.info("状態管理テーブルが更新されました。")
-
-            # 一時テーブルの削除
-            bq_client.delete_table(temp_table_id, not_found_ok=True)
+        # 必須の送信先が全て受信したパートの状態は、途中で失敗しても反映する(次回は未受信の行のみ再送する)
+        merge_state_updates(bq_client, exported_state_updates)
+
+        if not fanout.required_succeeded():
+            logger.error(f"アップロードに失敗しました: {fanout.errors}")
+            return f"アップロード失敗: {fanout.errors}", 500
+        if fanout.errors:
+            # 任意の送信先の失敗は再送しない
+            logger.warning(f"任意の送信先へのアップロードに失敗しました: {fanout.errors}")
+
+        set_export_watermark(bq_client, source_modified_ms)
 
         return f"成功。 {len(updates)} 行をエクスポートしました。", 200
 
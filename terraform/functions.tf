@@ -73,6 +73,8 @@ resource "google_cloudfunctions2_function" "export_schedules" {
       SECRET_USER = "projects/56638639323/secrets/kol_ftp_bubble_username"
       SECRET_PASS = "projects/56638639323/secrets/kol_ftp_bubble_password"
       FTP_DIRECTORY = terraform.workspace == "prd" ? "/production" : "/development"
+      EXPORT_SINKS  = "ftp" # 送信先(カンマ区切り)。gcs:<bucket>/<prefix> を追加する場合はSAにバケットへの書き込み権限が必要
+      EXPORT_OPTIONAL_SINKS = "" # 失敗しても状態管理テーブルを更新する(再送しない)送信先
     }
     service_account_email = google_service_account.export_schedules_sa.email
   }
@@ -154,7 +156,7 @@ resource "google_cloudfunctions2_function" "export_race_uma_details" {
   }
 
   service_config {
-    max_instance_count = 1
+    max_instance_count = 1 # 通常のエクスポートは直列に実行する(並列のバックフィルは export_race_uma_details_backfill を使用)
     available_memory   = "8192M" # メモリ不足解消のため増強
     available_cpu      = "4"     # 4GB以上のメモリには2CPU以上が必要、8GBなら4CPU推奨
     timeout_seconds    = 3600
@@ -164,6 +166,9 @@ resource "google_cloudfunctions2_function" "export_race_uma_details" {
       SECRET_USER = "projects/56638639323/secrets/kol_ftp_bubble_username"
       SECRET_PASS = "projects/56638639323/secrets/kol_ftp_bubble_password"
       FTP_DIRECTORY = terraform.workspace == "prd" ? "/production" : "/development"
+      EXPORT_SINKS  = "ftp" # 送信先(カンマ区切り)。gcs:<bucket>/<prefix> を追加する場合はSAにバケットへの書き込み権限が必要
+      EXPORT_OPTIONAL_SINKS = "" # 失敗しても状態管理テーブルを更新する(再送しない)送信先
+      EXPORT_DEADLINE_SECONDS = "3000" # timeout_seconds より前に打ち切り、アップロード済みの状態をMERGEする余裕を残す
     }
     service_account_email = google_service_account.export_race_uma_details_sa.email
   }
@@ -188,6 +193,62 @@ resource "google_cloud_run_service_iam_member" "workflows_invoker_race_uma_detai
   member   = "serviceAccount:${google_service_account.workflows_sa.email}"
 }
 
+# --- バックフィル用 Cloud Function Gen2 ---
+# 通常のエクスポート関数は max_instance_count = 1 で、シャード指定のない実行を直列に保つ。
+# シャード分割バックフィルは同じソース・SAのこの関数を並列に呼び出す。
+resource "google_cloudfunctions2_function" "export_race_uma_details_backfill" {
+  name        = "export-race-uma-details-backfill-function${local.env_suffix}"
+  location    = var.region
+  description = "Exports race uma details shards in parallel for backfills"
+  project     = var.project_id
+
+  build_config {
+    runtime     = "python311"
+    entry_point = "export_race_uma_details"
+    source {
+      storage_source {
+        bucket = google_storage_bucket.function_source_bucket.name
+        object = google_storage_bucket_object.export_race_uma_details_object.name
+      }
+    }
+  }
+
+  service_config {
+    max_instance_count = var.export_race_uma_details_backfill_max_instances # シャードを並列に実行するため
+    available_memory   = "8192M" # メモリ不足解消のため増強
+    available_cpu      = "4"     # 4GB以上のメモリには2CPU以上が必要、8GBなら4CPU推奨
+    timeout_seconds    = 3600
+    environment_variables = {
+      PROJECT_ID  = var.project_id
+      DATASET_ID  = terraform.workspace == "prd" ? var.prd_schema : var.stg_schema
+      SECRET_USER = "projects/56638639323/secrets/kol_ftp_bubble_username"
+      SECRET_PASS = "projects/56638639323/secrets/kol_ftp_bubble_password"
+      FTP_DIRECTORY = terraform.workspace == "prd" ? "/production" : "/development"
+      EXPORT_SINKS  = "ftp" # 送信先(カンマ区切り)。gcs:<bucket>/<prefix> を追加する場合はSAにバケットへの書き込み権限が必要
+      EXPORT_OPTIONAL_SINKS = "" # 失敗しても状態管理テーブルを更新する(再送しない)送信先
+      EXPORT_DEADLINE_SECONDS = "1200" # ワークフローのHTTP呼び出しの上限(1800秒)内に、最後のパートとMERGEの再試行が収まるようにする
+    }
+    service_account_email = google_service_account.export_race_uma_details_sa.email
+  }
+
+  depends_on = [
+      google_project_iam_member.export_race_uma_details_bq_editor,
+      google_project_iam_member.export_race_uma_details_bq_job_user
+  ]
+}
+
+output "export_race_uma_details_backfill_function_uri" {
+  value = google_cloudfunctions2_function.export_race_uma_details_backfill.service_config[0].uri
+}
+
+resource "google_cloud_run_service_iam_member" "workflows_invoker_race_uma_details_backfill" {
+  project  = var.project_id
+  location = var.region
+  service  = google_cloudfunctions2_function.export_race_uma_details_backfill.service_config[0].service
+  role     = "roles/run.invoker"
+  member   = "serviceAccount:${google_service_account.workflows_sa.email}"
+}
+
 # -----------------------------------------------------------------------------
 # レースエクスポート用 Cloud Function
 # -----------------------------------------------------------------------------
@@ -234,6 +295,8 @@ resource "google_cloudfunctions2_function" "export_races" {
       SECRET_USER = "projects/56638639323/secrets/kol_ftp_bubble_username"
       SECRET_PASS = "projects/56638639323/secrets/kol_ftp_bubble_password"
       FTP_DIRECTORY = terraform.workspace == "prd" ? "/production" : "/development"
+      EXPORT_SINKS  = "ftp" # 送信先(カンマ区切り)。gcs:<bucket>/<prefix> を追加する場合はSAにバケットへの書き込み権限が必要
+      EXPORT_OPTIONAL_SINKS = "" # 失敗しても状態管理テーブルを更新する(再送しない)送信先
     }
     service_account_email = google_service_account.export_schedules_sa.email # 同じSAを使用
   }
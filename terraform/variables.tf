@@ -45,4 +45,19 @@ variable "stg_schema" {
   description = "The BigQuery schema for the staging environment."
   type        = string
   default     = "kolbi_analysis_stg"
-}
\ No newline at end of file
+}
+
+# race_uma_details バックフィル用エクスポート関数の最大インスタンス数。
+# シャード分割バックフィル (race-uma-details-backfill ワークフロー) の並列度の上限になる。
+variable "export_race_uma_details_backfill_max_instances" {
+  description = "Maximum number of instances for the race uma details backfill export function (upper bound of backfill shard parallelism)."
+  type        = number
+  default     = 8
+}
+
+# バックフィル時の既定のシャード数。
+variable "race_uma_details_backfill_shards" {
+  description = "Default number of hash shards for the race uma details backfill workflow."
+  type        = number
+  default     = 8
+}
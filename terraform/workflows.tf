@@ -23,6 +23,19 @@ resource "google_project_iam_member" "workflows_log_writer" {
   member  = "serviceAccount:${google_service_account.workflows_sa.email}"
 }
 
+# 読み込まれたソーステーブルごとに、Dataformで再構築するマート(直接の依存先)
+# 間接的な依存先 (race_uma_details など) は transitiveDependentsIncluded で含める。
+# 一覧にないテーブルやイベントを解析できない場合は、従来どおり全アクションを実行する。
+locals {
+  dataform_trigger_dependents = {
+    kol_den1 = ["race", "race_uma", "schedule"]
+    kol_den2 = ["race_uma", "race_uma_chokyo"]
+    kol_ket  = ["race_uma"]
+    kol_sei1 = ["race", "race_uma"]
+    kol_sei2 = ["race_uma"]
+  }
+}
+
 # --- Cloud Workflow ---
 resource "google_workflows_workflow" "dataform_trigger_workflow_stg" {
   depends_on = [google_project_service.workflows]
@@ -41,6 +54,9 @@ main:
           - is_paused: false  # 停止したい時はここを true に、再開時は false にする
           - repository: "projects/${var.project_id}/locations/${var.region}/repositories/${google_dataform_repository.repository_stg.name}"
           - workspace: "${var.dataform_workspace_id}"
+          - dependentMarts: ${jsonencode(local.dataform_trigger_dependents)}
+          - triggerTable: null
+          - includedTargets: []
     - check_paused:
         switch:
           - condition: $${is_paused}
@@ -59,6 +75,47 @@ main:
               vars:
                 source_schema: "kolbi_keiba_stg"
         result: compilationResult
+    # Eventarc(Pub/Sub)のログエントリから読み込み先のテーブルを特定し、依存するマートだけを再構築する
+    - parseTriggerTable:
+        try:
+          steps:
+            - decodeEvent:
+                assign:
+                  - logEntry: $${json.decode(base64.decode(args.data.message.data))}
+                  - jobConfiguration: $${map.get(logEntry, ["protoPayload", "serviceData", "jobCompletedEvent", "job", "jobConfiguration"])}
+                  - triggerTable: $${default(map.get(jobConfiguration, ["load", "destinationTable", "tableId"]), map.get(jobConfiguration, ["query", "destinationTable", "tableId"]))}
+        except:
+          as: e
+          steps:
+            - logParseError:
+                call: sys.log
+                args:
+                  severity: WARNING
+                  text: $${"トリガーのテーブルを特定できないため、全アクションを実行します: " + json.encode_to_string(e)}
+    - buildInvocationConfig:
+        assign:
+          - invocationConfig:
+              serviceAccount: "dataform-runner-stg@${var.project_id}.iam.gserviceaccount.com"
+    - narrowTargets:
+        switch:
+          - condition: $${triggerTable != null and map.get(dependentMarts, triggerTable) != null}
+            steps:
+              - collectTargets:
+                  for:
+                    value: mart
+                    in: $${dependentMarts[triggerTable]}
+                    steps:
+                      - appendTarget:
+                          assign:
+                            - target:
+                                database: "${var.project_id}"
+                                schema: "${var.stg_schema}"
+                                name: $${mart}
+                            - includedTargets: $${list.concat(includedTargets, target)}
+              - setIncludedTargets:
+                  assign:
+                    - invocationConfig["includedTargets"]: $${includedTargets}
+                    - invocationConfig["transitiveDependentsIncluded"]: true
     - createWorkflowInvocation:
         call: http.post
         args:
@@ -67,8 +124,7 @@ main:
             type: OAuth2
           body:
             compilationResult: $${compilationResult.body.name}
-            invocationConfig:
-              serviceAccount: "dataform-runner-stg@${var.project_id}.iam.gserviceaccount.com"
+            invocationConfig: $${invocationConfig}
         result: workflowInvocation
     # Dataform実行完了を待つロジックが必要だが、非同期呼出のままにするか、Dataform完了をポーリングするか。
     # 既存コードはInvocation作成だけしてリターンしているため、Dataformの完了を待っていない。
@@ -95,15 +151,49 @@ main:
           - condition: $${dataformStatus.body.state == "RUNNING" or dataformStatus.body.state == "CANCELING"}
             next: waitForDataform
           - condition: $${dataformStatus.body.state == "SUCCEEDED"}
-            next: callExportScheduleFunction
+            next: initExportBody
           - condition: true
             return: $${"Dataform failed with state " + dataformStatus.body.state}
+    # 今回のDataform実行で再構築されたアクションを取得し、エクスポート関数に渡す
+    # (ソースマートが再構築されていないエクスポートは差分クエリを発行せずに終了する)
+    # アクションを取得できない場合(失敗・項目なし・ページ分割)は dataform_actions を送らず、
+    # エクスポート関数側で最終更新時刻とウォーターマークの比較のみで判定させる
+    - initExportBody:
+        assign:
+          - dataformActions: {}
+          - exportBody: {}
+    - queryDataformActions:
+        try:
+          call: http.get
+          args:
+            url: $${"https://dataform.googleapis.com/v1beta1/" + workflowInvocation.body.name + ":query"}
+            auth:
+              type: OAuth2
+            query:
+              pageSize: 1000
+          result: dataformActions
+        except:
+          as: e
+          steps:
+            - logQueryError:
+                call: sys.log
+                args:
+                  severity: WARNING
+                  text: $${"Dataformアクションの取得に失敗しました: " + json.encode_to_string(e)}
+    - setDataformActions:
+        switch:
+          - condition: $${map.get(dataformActions, ["body", "workflowInvocationActions"]) != null and map.get(dataformActions, ["body", "nextPageToken"]) == null}
+            steps:
+              - assignDataformActions:
+                  assign:
+                    - exportBody["dataform_actions"]: $${dataformActions.body.workflowInvocationActions}
     - callExportScheduleFunction:
         call: http.post
         args:
           url: "${google_cloudfunctions2_function.export_schedules.service_config[0].uri}"
           auth:
             type: OIDC
+          body: $${exportBody}
         result: exportScheduleResult
     - callExportRacesFunction:
         call: http.post
@@ -111,6 +201,7 @@ main:
           url: "${google_cloudfunctions2_function.export_races.service_config[0].uri}"
           auth:
             type: OIDC
+          body: $${exportBody}
         result: exportRacesResult
     - returnResult:
         return:
@@ -136,6 +227,9 @@ main:
         assign:
           - repository: "projects/${var.project_id}/locations/${var.region}/repositories/${google_dataform_repository.repository_prd.name}"
           - workspace: "${var.dataform_workspace_id}"
+          - dependentMarts: ${jsonencode(local.dataform_trigger_dependents)}
+          - triggerTable: null
+          - includedTargets: []
     - createCompilationResult:
         call: http.post
         args:
@@ -150,6 +244,47 @@ main:
               vars:
                 source_schema: "kolbi_keiba"
         result: compilationResult
+    # Eventarc(Pub/Sub)のログエントリから読み込み先のテーブルを特定し、依存するマートだけを再構築する
+    - parseTriggerTable:
+        try:
+          steps:
+            - decodeEvent:
+                assign:
+                  - logEntry: $${json.decode(base64.decode(args.data.message.data))}
+                  - jobConfiguration: $${map.get(logEntry, ["protoPayload", "serviceData", "jobCompletedEvent", "job", "jobConfiguration"])}
+                  - triggerTable: $${default(map.get(jobConfiguration, ["load", "destinationTable", "tableId"]), map.get(jobConfiguration, ["query", "destinationTable", "tableId"]))}
+        except:
+          as: e
+          steps:
+            - logParseError:
+                call: sys.log
+                args:
+                  severity: WARNING
+                  text: $${"トリガーのテーブルを特定できないため、全アクションを実行します: " + json.encode_to_string(e)}
+    - buildInvocationConfig:
+        assign:
+          - invocationConfig:
+              serviceAccount: "dataform-runner@${var.project_id}.iam.gserviceaccount.com"
+    - narrowTargets:
+        switch:
+          - condition: $${triggerTable != null and map.get(dependentMarts, triggerTable) != null}
+            steps:
+              - collectTargets:
+                  for:
+                    value: mart
+                    in: $${dependentMarts[triggerTable]}
+                    steps:
+                      - appendTarget:
+                          assign:
+                            - target:
+                                database: "${var.project_id}"
+                                schema: "${var.prd_schema}"
+                                name: $${mart}
+                            - includedTargets: $${list.concat(includedTargets, target)}
+              - setIncludedTargets:
+                  assign:
+                    - invocationConfig["includedTargets"]: $${includedTargets}
+                    - invocationConfig["transitiveDependentsIncluded"]: true
     - createWorkflowInvocation:
         call: http.post
         args:
@@ -158,8 +293,7 @@ main:
             type: OAuth2
           body:
             compilationResult: $${compilationResult.body.name}
-            invocationConfig:
-              serviceAccount: "dataform-runner@${var.project_id}.iam.gserviceaccount.com"
+            invocationConfig: $${invocationConfig}
         result: workflowInvocation
     # Dataform完了待機
     - waitForDataform:
@@ -178,15 +312,49 @@ main:
           - condition: $${dataformStatus.body.state == "RUNNING" or dataformStatus.body.state == "CANCELING"}
             next: waitForDataform
           - condition: $${dataformStatus.body.state == "SUCCEEDED"}
-            next: callExportScheduleFunction
+            next: initExportBody
           - condition: true
             return: $${"Dataform failed with state " + dataformStatus.body.state}
+    # 今回のDataform実行で再構築されたアクションを取得し、エクスポート関数に渡す
+    # (ソースマートが再構築されていないエクスポートは差分クエリを発行せずに終了する)
+    # アクションを取得できない場合(失敗・項目なし・ページ分割)は dataform_actions を送らず、
+    # エクスポート関数側で最終更新時刻とウォーターマークの比較のみで判定させる
+    - initExportBody:
+        assign:
+          - dataformActions: {}
+          - exportBody: {}
+    - queryDataformActions:
+        try:
+          call: http.get
+          args:
+            url: $${"https://dataform.googleapis.com/v1beta1/" + workflowInvocation.body.name + ":query"}
+            auth:
+              type: OAuth2
+            query:
+              pageSize: 1000
+          result: dataformActions
+        except:
+          as: e
+          steps:
+            - logQueryError:
+                call: sys.log
+                args:
+                  severity: WARNING
+                  text: $${"Dataformアクションの取得に失敗しました: " + json.encode_to_string(e)}
+    - setDataformActions:
+        switch:
+          - condition: $${map.get(dataformActions, ["body", "workflowInvocationActions"]) != null and map.get(dataformActions, ["body", "nextPageToken"]) == null}
+            steps:
+              - assignDataformActions:
+                  assign:
+                    - exportBody["dataform_actions"]: $${dataformActions.body.workflowInvocationActions}
     - callExportScheduleFunction:
         call: http.post
         args:
           url: "${google_cloudfunctions2_function.export_schedules.service_config[0].uri}"
           auth:
             type: OIDC
+          body: $${exportBody}
         result: exportScheduleResult
     - callExportRacesFunction:
         call: http.post
@@ -194,6 +362,7 @@ main:
           url: "${google_cloudfunctions2_function.export_races.service_config[0].uri}"
           auth:
             type: OIDC
+          body: $${exportBody}
         result: exportRacesResult
     - returnResult:
         return:
@@ -202,3 +371,140 @@ main:
           exportRaces: $${exportRacesResult.body}
 EOF
 }
+
+# -----------------------------------------------------------------------------
+# race_uma_details シャード分割バックフィル用 Cloud Workflows
+#
+# 実行例:
+#   gcloud workflows run race-uma-details-backfill --data='{"shard_count": 8}'
+#   gcloud workflows run race-uma-details-backfill --data='{"year_from": 2015, "year_to": 2024}'
+# shard_count 指定時は race_code_uma_jvd の安定ハッシュで、year_from/year_to 指定時は
+# hasso_date の年ごとにシャードを分け、エクスポート関数を並列に呼び出す。
+# 各シャードは互いに素なキーの状態を個別にMERGEするため、状態管理テーブルの更新は競合しない。
+# 各シャードは deadline_seconds で打ち切られ、"partial" が返る間は継続して呼び出す。
+# -----------------------------------------------------------------------------
+resource "google_workflows_workflow" "race_uma_details_backfill" {
+  depends_on      = [google_project_service.workflows]
+  name            = "race-uma-details-backfill${local.env_suffix}"
+  region          = var.region
+  description     = "race_uma_detailsのエクスポートをシャード分割して並列実行するバックフィル用ワークフロー"
+  service_account = google_service_account.workflows_sa.id
+  project         = var.project_id
+
+  source_contents = <<EOF
+main:
+  params: [args]
+  steps:
+    - init:
+        assign:
+          - shard_count: $${default(map.get(args, "shard_count"), ${var.race_uma_details_backfill_shards})}
+          - year_from: $${map.get(args, "year_from")}
+          - year_to: $${map.get(args, "year_to")}
+          - results: {}
+    - selectMode:
+        switch:
+          - condition: $${(year_from == null) != (year_to == null)}
+            raise: "year_from と year_to は両方指定してください。"
+          - condition: $${year_from != null and year_to != null}
+            next: runYearShards
+        next: runHashShards
+    - runHashShards:
+        parallel:
+          shared: [results]
+          concurrency_limit: ${var.export_race_uma_details_backfill_max_instances}
+          for:
+            value: shard_index
+            range: $${[0, shard_count - 1]}
+            steps:
+              - callHashShard:
+                  try:
+                    call: export_until_complete
+                    args:
+                      body:
+                        shard_index: $${shard_index}
+                        shard_count: $${shard_count}
+                    result: shardResult
+                  except:
+                    as: e
+                    steps:
+                      - storeHashShardError:
+                          assign:
+                            - results[string(shard_index)]: $${e}
+                          next: continue
+              - storeHashShardResult:
+                  assign:
+                    - results[string(shard_index)]: $${shardResult}
+        next: returnResult
+    - runYearShards:
+        parallel:
+          shared: [results]
+          concurrency_limit: ${var.export_race_uma_details_backfill_max_instances}
+          for:
+            value: year
+            range: $${[year_from, year_to]}
+            steps:
+              - callYearShard:
+                  try:
+                    call: export_until_complete
+                    args:
+                      body:
+                        year_from: $${year}
+                        year_to: $${year}
+                    result: shardResult
+                  except:
+                    as: e
+                    steps:
+                      - storeYearShardError:
+                          assign:
+                            - results[string(year)]: $${e}
+                          next: continue
+              - storeYearShardResult:
+                  assign:
+                    - results[string(year)]: $${shardResult}
+    - returnResult:
+        return: $${results}
+
+# エクスポート関数を呼び出し、期限により "partial" が返る間は続きのパート番号から再実行する
+# HTTP呼び出しのタイムアウト(最大1800秒)内に収まるよう、関数側の期限は短めに指定する
+export_until_complete:
+  params: [body]
+  steps:
+    - init:
+        assign:
+          - body["deadline_seconds"]: 1200
+          - body["part_start"]: 1
+          - invocations: 0
+          - exported_rows: 0
+    - callExport:
+        call: http.post
+        args:
+          url: "${google_cloudfunctions2_function.export_race_uma_details_backfill.service_config[0].uri}"
+          auth:
+            type: OIDC
+          timeout: 1800
+          body: $${body}
+        result: exportResult
+    - countInvocation:
+        assign:
+          - invocations: $${invocations + 1}
+    - checkResultType:
+        switch:
+          - condition: $${get_type(exportResult.body) != "map"}
+            next: done
+    - checkPartial:
+        switch:
+          - condition: $${map.get(exportResult.body, "status") == "partial"}
+            next: continueExport
+        next: done
+    - continueExport:
+        assign:
+          - exported_rows: $${exported_rows + exportResult.body.exported_rows}
+          - body["part_start"]: $${exportResult.body.next_part_start}
+        next: callExport
+    - done:
+        return:
+          invocations: $${invocations}
+          partial_exported_rows: $${exported_rows}
+          result: $${exportResult.body}
+EOF
+}